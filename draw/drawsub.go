@@ -29,6 +29,54 @@ type DrawBothResponse struct {
 	Bubbles map[string]interface{} `json:"bubbles"`
 }
 
+// DrawFramedMimetype is the binary /draw?both=1 response:
+// 8 byte big-endian length, json {"bubbles":...}, 8 byte big-endian length, raw pdf
+const DrawFramedMimetype = "application/x-ballotstudio-frames"
+
+type drawFramedHeader struct {
+	Bubbles json.RawMessage `json:"bubbles"`
+}
+
+// maxFrameLen bounds one frame of a framed draw response, well past any real ballot pdf.
+// A corrupt or truncated length shouldn't make us allocate gigabytes.
+const maxFrameLen = 1 << 30
+
+// readFrame reads an 8 byte big-endian length and then that many bytes
+func readFrame(reader io.Reader) ([]byte, error) {
+	var sizebytes [8]byte
+	_, err := io.ReadFull(reader, sizebytes[:])
+	if err != nil {
+		return nil, fmt.Errorf("reading frame size, %v", err)
+	}
+	framelen := binary.BigEndian.Uint64(sizebytes[:])
+	if framelen > maxFrameLen {
+		return nil, fmt.Errorf("frame size %d over limit %d", framelen, maxFrameLen)
+	}
+	frame := make([]byte, framelen)
+	_, err = io.ReadFull(io.LimitReader(reader, int64(framelen)), frame)
+	if err != nil {
+		return nil, fmt.Errorf("reading frame, %v", err)
+	}
+	return frame, nil
+}
+
+func readDrawFramed(reader io.Reader) (both *DrawBothOb, err error) {
+	headerbytes, err := readFrame(reader)
+	if err != nil {
+		return nil, fmt.Errorf("draw POST bad response header, %v", err)
+	}
+	var header drawFramedHeader
+	err = json.Unmarshal(headerbytes, &header)
+	if err != nil {
+		return nil, fmt.Errorf("draw POST bad response header json, %v", err)
+	}
+	pdf, err := readFrame(reader)
+	if err != nil {
+		return nil, fmt.Errorf("draw POST bad response pdf, %v", err)
+	}
+	return &DrawBothOb{Pdf: pdf, BubblesJson: []byte(header.Bubbles)}, nil
+}
+
 // DrawServer runs a development
 // FLASK_ENV=development FLASK_APP=draw/app.py "${HOME}/bsvenv/bin/flask" run -p 8081
 type DrawServer struct {
@@ -151,10 +199,18 @@ func DrawElection(backendUrl string, electionjson string) (both *DrawBothOb, err
 	nurl.RawQuery = "both=1"
 	drawurl := nurl.String()
 	postbody := strings.NewReader(electionjson)
-	resp, err := http.DefaultClient.Post(drawurl, "application/json", postbody)
+	req, err := http.NewRequest("POST", drawurl, postbody)
+	if err != nil {
+		return nil, fmt.Errorf("draw POST, %v", err)
+	}
+	req.Header.Set("Content-Type", "application/json")
+	// raw pdf bytes if the draw server has them, base64 in json otherwise
+	req.Header.Set("Accept", DrawFramedMimetype+", application/json;q=0.5")
+	resp, err := http.DefaultClient.Do(req)
 	if err != nil {
 		return nil, fmt.Errorf("draw POST, %v", err)
 	}
+	defer resp.Body.Close()
 	if resp.StatusCode != 200 {
 		body, _ := ioutil.ReadAll(resp.Body)
 		if len(body) > 50 {
@@ -162,6 +218,9 @@ func DrawElection(backendUrl string, electionjson string) (both *DrawBothOb, err
 		}
 		return nil, fmt.Errorf("draw POST %d %#v", resp.StatusCode, string(body))
 	}
+	if resp.Header.Get("Content-Type") == DrawFramedMimetype {
+		return readDrawFramed(resp.Body)
+	}
 	body, err := ioutil.ReadAll(resp.Body)
 	//dec := json.NewDecoder(resp.Body)
 	var dbr DrawBothResponse
@@ -1,15 +1,20 @@
 # pip install Flask
-# pdf to png requires ghostscript `pdftoppm` and ImageMagick `convert`
+# pdf to png requires poppler-utils `pdftoppm`
 import base64
+import concurrent.futures
+import hashlib
 import io
 import json
 import logging
 import os
+import shutil
 import sqlite3
-import subprocess
+import struct
+import tempfile
+import threading
 import time
 
-from flask import Flask, render_template, request, g, url_for
+from flask import Flask, Response, render_template, request, g, has_request_context, url_for
 # pip install python-memcached
 #import memcache
 memcache = None
@@ -19,6 +24,8 @@ from . import demorace
 from . import randrace
 from . import randvote
 from . import draw
+from . import metrics
+from . import raster
 ElectionPrinter = draw.ElectionPrinter
 
 app = Flask(__name__, template_folder=os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')))
@@ -34,6 +41,11 @@ draw.logger = app.logger
 
 _cache = None
 
+renderSeconds = metrics.Histogram('ballotstudio_render_seconds', 'time to render election pdfs, by endpoint')
+pdfToPngSeconds = metrics.Histogram('ballotstudio_pdftopng_seconds', 'time to rasterize a pdf page to png')
+stylesRendered = metrics.Counter('ballotstudio_ballot_styles_rendered_total', 'ballot styles drawn to pdf')
+pagesRendered = metrics.Counter('ballotstudio_pages_rendered_total', 'pdf pages drawn')
+
 def mc():
     # use memcached if installed?
     if memcache is not None:
@@ -44,59 +56,174 @@ def mc():
     # use local built in cache
     global _cache
     if _cache is None:
-        _cache = cache.Cache()
+        _cache = cache.Cache(_cacheBytes())
     return _cache
 
+def _cacheBytes():
+    "byte budget for each in-process cache, $BALLOTSTUDIO_CACHE_MB default 256"
+    return int(os.getenv('BALLOTSTUDIO_CACHE_MB') or 256) * 1024 * 1024
+
+_renderCache = None
+# one render per cache key at a time, concurrent requests for it wait and share the result
+_renderFlight = cache.SingleFlight()
+
+# written into each per-version render cache directory, only directories holding it are ever removed
+_RENDER_VERSION_MARKER = '.ballotstudio-render-version'
+
+def _pruneRenderVersions(path, keep):
+    "remove render cache directories of other draw.RENDER_VERSIONs, nothing will read them again"
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    for name in names:
+        vpath = os.path.join(path, name)
+        if (name == keep) or not os.path.isfile(os.path.join(vpath, _RENDER_VERSION_MARKER)):
+            continue
+        shutil.rmtree(vpath, ignore_errors=True)
+        app.logger.info('removed render cache %s from older drawing code', vpath)
+
+def _renderVersionDir(path, version):
+    "path/version, made and marked as ours"
+    vpath = os.path.join(path, version)
+    os.makedirs(vpath, exist_ok=True)
+    with open(os.path.join(vpath, _RENDER_VERSION_MARKER), 'wt') as fout:
+        fout.write(version + '\n')
+    return vpath
+
+def rc():
+    """content addressed render cache, keys are fingerprints of what was drawn.
+    memory, then $BALLOTSTUDIO_RENDER_CACHE directory (empty string disables, default ~/.cache/ballotstudio/render)
+    capped at $BALLOTSTUDIO_RENDER_CACHE_MB (default 512).
+    Files go in a subdirectory per draw.RENDER_VERSION, other versions' (those with our marker file) are removed."""
+    global _renderCache
+    if _renderCache is None:
+        path = os.getenv('BALLOTSTUDIO_RENDER_CACHE')
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache', 'ballotstudio', 'render')
+        if path:
+            _pruneRenderVersions(path, draw.RENDER_VERSION)
+            path = _renderVersionDir(path, draw.RENDER_VERSION)
+        maxBytes = int(os.getenv('BALLOTSTUDIO_RENDER_CACHE_MB') or 512) * 1024 * 1024
+        _renderCache = cache.RenderCache(path or None, maxBytes, memoryBytes=_cacheBytes())
+    return _renderCache
+
+# rendered output of an election, hash is draw.electionFingerprint() of what was rendered
+# kind 'pdf', 'bubbles' (json), 'png{dpi}' at raster.DEFAULT_DPI only (page is 1 based)
+_artifacts_schema = "CREATE TABLE IF NOT EXISTS artifacts (election INT, hash TEXT, kind TEXT, page INT, data BLOB, PRIMARY KEY (election, hash, kind, page))"
+
 # TODO: ownership, ACLs, any kind of security at all
 current_schema = [
     "CREATE TABLE IF NOT EXISTS elections (data TEXT, meta TEXT)", # use builtin ROWID
     "CREATE TABLE IF NOT EXISTS migrations (mid INT PRIMARY KEY) WITHOUT ROWID",
+    _artifacts_schema,
 ]
 
 # never delete a migration or change its int key
 migrations = [
-    (1, ["CREATE TABLE IF NOT EXISTS migrations (mid INT PRIMARY KEY) WITHOUT ROWID","ALTER TABLE elections ADD COLUMN meta TEXT"])
+    (1, ["CREATE TABLE IF NOT EXISTS migrations (mid INT PRIMARY KEY) WITHOUT ROWID","ALTER TABLE elections ADD COLUMN meta TEXT"]),
+    (2, [_artifacts_schema]),
 ]
 
+def _initdb(conn):
+    "create or migrate the schema, make sure the demo election exists"
+    c = conn.cursor()
+    try:
+        c.execute("SELECT mid FROM migrations")
+        migrations_done = set([row[0] for row in c.fetchall()])
+    except:
+        migrations_done = set()
+    try:
+        c.execute("SELECT COUNT(*) FROM elections")
+        row = c.fetchone()
+        num_elections = row and row[0]
+    except:
+        num_elections = 0
+    if not num_elections:
+        # new db
+        for stmt in current_schema:
+            c.execute(stmt)
+        # mark all migrations as applied
+        c.executemany("INSERT OR IGNORE INTO migrations (mid) VALUES (?)", [(mig[0],) for mig in migrations])
+    else:
+        migs_applied = []
+        for mig in migrations:
+            mid = mig[0]
+            if mid not in migrations_done:
+                for stmt in mig[1]:
+                    c.execute(stmt)
+                migs_applied.append( (mid,) )
+        c.executemany("INSERT INTO migrations (mid) VALUES (?)", migs_applied)
+    conn.commit()
+    demo = _getelection(1, conn)
+    if not demo:
+        _putelection(demorace.ElectionReport, 1, conn)
+
+class ConnectionPool:
+    """sqlite3 connections reused across requests.
+    The schema is initialized and migrated once, when the pool is made."""
+    def __init__(self, path, size=8):
+        self.path = path
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        conn = self.connect()
+        _initdb(conn)
+        self.put(conn)
+
+    def connect(self):
+        # handed between request threads, never used by two at once
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # readers don't block the writer or each other
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL is still safe across crashes with NORMAL, just not power loss of the last commits
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connect()
+
+    def put(self, conn):
+        if conn.in_transaction:
+            # request ended without commit
+            conn.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+_pool = None
+_poolLock = threading.Lock()
+
+def pool():
+    "$BALLOTSTUDIO_SQLITE (default ballotstudio.sqlite), up to $BALLOTSTUDIO_SQLITE_POOL (default 8) idle connections"
+    global _pool
+    if _pool is None:
+        with _poolLock:
+            if _pool is None:
+                sqlite3path = os.getenv('BALLOTSTUDIO_SQLITE') or 'ballotstudio.sqlite'
+                _pool = ConnectionPool(sqlite3path, int(os.getenv('BALLOTSTUDIO_SQLITE_POOL') or 8))
+    return _pool
+
 def db():
+    "this request's connection, from pool() and returned to it at teardown"
     conn = getattr(g, '_database', None)
     if conn is None:
-        sqlite3path = os.getenv('BALLOTSTUDIO_SQLITE') or 'ballotstudio.sqlite'
-        conn = sqlite3.connect(sqlite3path)
-        c = conn.cursor()
-        try:
-            c.execute("SELECT mid FROM migrations")
-            migrations_done = set([row[0] for row in c.fetchall()])
-        except:
-            migrations_done = set()
-        try:
-            c.execute("SELECT COUNT(*) FROM elections")
-            row = c.fetchone()
-            num_elections = row and row[0]
-        except:
-            num_elections = 0
-        if not num_elections:
-            # new db
-            for stmt in current_schema:
-                c.execute(stmt)
-            # mark all migrations as applied
-            c.executemany("INSERT INTO migrations (mid) VALUES (?)", [(mig[0],) for mig in migrations])
-        else:
-            migs_applied = []
-            for mig in migrations:
-                mid = mig[0]
-                if mid not in migrations_done:
-                    for stmt in mig[1]:
-                        c.execute(stmt)
-                    migs_applied.append( (mid,) )
-            c.executemany("INSERT INTO migrations (mid) VALUES (?)", migs_applied)
-        conn.commit()
-        demo = _getelection(1, conn)
-        if not demo:
-            _putelection(demorace.ElectionReport, 1, conn)
-        g._database = conn
+        conn = g._database = pool().get()
     return conn
 
+@app.teardown_appcontext
+def _dbteardown(exc):
+    conn = g.pop('_database', None)
+    if conn is not None:
+        pool().put(conn)
+
 def putelection(ob, itemid=None):
     conn = db()
     return _putelection(ob, itemid, conn)
@@ -125,25 +252,136 @@ def getelection(itemid):
     return _getelection(itemid, conn)
 
 def _getelection(itemid, conn):
+    data = _getelectiondata(itemid, conn)
+    if data is None:
+        return None
+    return json.loads(data)
+
+def _getelectiondata(itemid, conn):
+    "stored json text"
     c = conn.cursor()
     c.execute("SELECT data FROM elections WHERE ROWID = ?", (int(itemid),))
     row = c.fetchone()
     c.close()
     if not row:
         return None
-    return json.loads(row[0])
+    return row[0]
+
+def _election_ref(itemid):
+    """(stored json text, draw.electionFingerprint()) of a saved election, (None, None) if there isn't one.
+    The fingerprint is remembered by hash of the text, so checking an ETag doesn't parse or re-serialize the election."""
+    data = _getelectiondata(itemid, db())
+    if data is None:
+        return None, None
+    return data, _datafingerprint(data)
+
+def _datafingerprint(data):
+    "draw.electionFingerprint() of stored json text, remembered by hash of the text"
+    cachekey = 'fp{}'.format(hashlib.sha256(data.encode()).hexdigest())
+    fingerprint = mc().get(cachekey)
+    if fingerprint is None:
+        fingerprint = draw.electionFingerprint(json.loads(data))
+        mc().set(cachekey, fingerprint, time=3600)
+    return fingerprint
+
+def getartifact(conn, itemid, fingerprint, kind, page=0):
+    "artifact bytes, or None"
+    c = conn.cursor()
+    c.execute("SELECT data FROM artifacts WHERE election = ? AND hash = ? AND kind = ? AND page = ?", (int(itemid), fingerprint, kind, page))
+    row = c.fetchone()
+    c.close()
+    if not row:
+        return None
+    return row[0]
 
+def putartifacts(conn, itemid, fingerprint, artifacts):
+    """artifacts {kind: bytes} or {(kind, page): bytes} for election itemid rendered as fingerprint.
+    Artifacts of the election's other (older) fingerprints are dropped.
+    Only written if fingerprint is still that of the stored election, checked in the same transaction,
+    so a late render of an older version can't replace the current one. Returns True if written."""
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT data FROM elections WHERE ROWID = ?", (int(itemid),))
+        row = c.fetchone()
+        if (not row) or (_datafingerprint(row[0]) != fingerprint):
+            conn.rollback()
+            return False
+        c.execute("DELETE FROM artifacts WHERE election = ? AND hash != ?", (int(itemid), fingerprint))
+        rows = []
+        for kind, data in artifacts.items():
+            page = 0
+            if isinstance(kind, tuple):
+                kind, page = kind
+            rows.append((int(itemid), fingerprint, kind, page, data))
+        c.executemany("INSERT OR REPLACE INTO artifacts (election, hash, kind, page, data) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        return True
+    except:
+        conn.rollback()
+        raise
+    finally:
+        c.close()
 
-# pdf bytes in, png bytes out
-# bounces of two subprocess calls (all pipes, no disk) 'pdftoppm' and 'convert'
-def pdfToPng(pdfbytes):
-    result = subprocess.run(['pdftoppm'], input=pdfbytes, stdout=subprocess.PIPE)
-    result.check_returncode()
-    ppmbytes = result.stdout
-    result = subprocess.run(['convert', 'ppm:-', 'png:-'], input=ppmbytes, stdout=subprocess.PIPE)
-    result.check_returncode()
-    return result.stdout # png bytes
 
+# pdf bytes in, png bytes of one page out
+def pdfToPng(pdfbytes, page=1, dpi=raster.DEFAULT_DPI):
+    with pdfToPngSeconds.time():
+        return raster.pageToPng(pdfbytes, page, dpi)
+
+
+# streamed pdf output beyond this many bytes spools to a temp file instead of memory
+STREAM_SPOOL_BYTES = 1024*1024
+STREAM_CHUNK_BYTES = 64*1024
+
+def _count_rendered(ep, indexes=None):
+    "count ballot styles (all, or those indexes) and their pages as drawn, after their layout is known"
+    if indexes is None:
+        indexes = range(len(ep.ballot_styles))
+    for i in indexes:
+        stylesRendered.inc()
+        pagesRendered.inc(ep.styleLayout(i).numPages)
+
+def _render_endpoint():
+    "metrics label for what a render is for"
+    if has_request_context():
+        return request.endpoint
+    return 'background'
+
+def _pdf_stream(ep):
+    """render ep's pdf into a spooled temp file, respond with it in chunks.
+    Nothing held in memory per request beyond the render itself and STREAM_SPOOL_BYTES."""
+    out = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_BYTES)
+    try:
+        with renderSeconds.time(endpoint=_render_endpoint()):
+            ep.drawToFile(out)
+    except:
+        out.close()
+        raise
+    _count_rendered(ep)
+    size = out.tell()
+    out.seek(0)
+    def chunks():
+        try:
+            while True:
+                block = out.read(STREAM_CHUNK_BYTES)
+                if not block:
+                    break
+                yield block
+        finally:
+            out.close()
+    return Response(chunks(), 200, {"Content-Type":"application/pdf", "Content-Length":str(size)})
+
+def _not_modified(etag):
+    "request's If-None-Match already has etag"
+    return request.if_none_match.contains(etag)
+
+def _cache_headers(etag, headers=None):
+    "strong ETag, clients may keep the response but must revalidate since the url's content changes on edit"
+    out = dict(headers or {})
+    out['ETag'] = '"{}"'.format(etag)
+    out['Cache-Control'] = 'no-cache'
+    return out
 
 def requestbool(name):
     v = request.args.get(name)
@@ -178,9 +416,7 @@ def demoracebubbles():
     elections = er.get('Election', [])
     el = elections[0]
     ep = ElectionPrinter(er, el)
-    pdfbytes = io.BytesIO()
-    ep.drawToFile(outfile=pdfbytes)
-    #pdfbytes = pdfbytes.getvalue()
+    # layout only, no pdf
     bubbles = ep.getBubbles()
     return bubbles, 200, {"Content-Type":"application/json"}
 
@@ -210,10 +446,7 @@ def randracepdf():
     if requestbool('marked'):
         marks = randvote.randVote(er)
         ep.setMarks(marks)
-    pdfbytes = io.BytesIO()
-    ep.drawToFile(outfile=pdfbytes)
-    pdfbytes = pdfbytes.getvalue()
-    return pdfbytes, 200, {"Content-Type":"application/pdf"}
+    return _pdf_stream(ep)
 
 @app.route('/edit/<int:electionid>')
 def edit(electionid):
@@ -229,17 +462,20 @@ def drawHandler():
     if request.content_type != 'application/json':
         return 'bad content-type', 400
     er = request.get_json()
-    elections = er.get('Election', [])
-    el = elections[0]
-    ep = ElectionPrinter(er, el)
-    pdfbytes = io.BytesIO()
-    ep.drawToFile(outfile=pdfbytes)
-    pdfbytes = pdfbytes.getvalue()
+    cachekey = _render_key(er)
+    # stored on a miss so an identical POST, plain pdf or not, isn't drawn again
+    rendered = _er_bothob_cached(er, cachekey=cachekey)
+    pdfbytes = rendered['pdf']
+    if not (request.args.get('both') or request.args.get('bubbles')):
+        # just pdf
+        return pdfbytes, 200, {"Content-Type":"application/pdf"}
     if len(pdfbytes) == 0:
         app.logger.warning('zero byte pdf /draw')
+    if request.args.get('both') and _accepts_framed():
+        return _framed_response(rendered['bubbles'], pdfbytes)
     bothob = {
         'pdfb64': base64.b64encode(pdfbytes).decode(),
-        'bubbles': ep.getBubbles(),
+        'bubbles': rendered['bubbles'],
     }
     if request.args.get('both'):
         return bothob, 200
@@ -247,26 +483,43 @@ def drawHandler():
         itemid = request.args.get('i')
         if not itemid:
             itemid = '{:08x}'.format(int(time.time()-1588036000))
-        mc().set(itemid, bothob, time=3600)
-        return {'bubbles':ep.getBubbles(),'item':itemid}, 200
-    # otherwise just pdf
-    return pdfbytes, 200, {"Content-Type":"application/pdf"}
+        mc().set(itemid, {'both':bothob, 'etag':cachekey}, time=3600)
+        return {'bubbles':bothob['bubbles'],'item':itemid}, 200
+
+# /draw?both=1 binary alternative to {"pdfb64":..., "bubbles":...} json, asked for by Accept header.
+# Two frames, each an 8 byte big-endian length then that many bytes:
+# json {"bubbles":...} then the raw pdf. Same length prefix as `pdftoppm -pngMultiBlock` pages.
+DRAW_FRAMED_MIMETYPE = 'application/x-ballotstudio-frames'
+
+def _accepts_framed():
+    return request.accept_mimetypes.best_match(['application/json', DRAW_FRAMED_MIMETYPE]) == DRAW_FRAMED_MIMETYPE
+
+def _framed_response(bubbles, pdfbytes):
+    header = json.dumps({'bubbles':bubbles}).encode()
+    # chunks go out as they are, the pdf isn't copied into one body
+    chunks = [struct.pack('>Q', len(header)), header, struct.pack('>Q', len(pdfbytes)), pdfbytes]
+    size = sum([len(x) for x in chunks])
+    return Response(chunks, 200, {"Content-Type":DRAW_FRAMED_MIMETYPE, "Content-Length":str(size)})
 
 @app.route('/item')
 def itemHandler():
     itemid = request.args.get('i')
     if not itemid:
         return '', 404
-    bothob = mc().get(itemid)
-    if not bothob:
+    item = mc().get(itemid)
+    if not item:
         return '', 404
+    etag = item['etag']
+    if _not_modified(etag):
+        return '', 304, _cache_headers(etag)
+    bothob = item['both']
     if request.args.get('both'):
-        return bothob, 200
+        return bothob, 200, _cache_headers(etag)
     if request.args.get('bubbles'):
-        return {'bubbles':bothob['bubbles'],'item':itemid}, 200
+        return {'bubbles':bothob['bubbles'],'item':itemid}, 200, _cache_headers(etag)
     # otherwise just pdf
     pdfbytes = base64.b64decode(bothob['pdfb64'])
-    return pdfbytes, 200, {"Content-Type":"application/pdf"}
+    return pdfbytes, 200, _cache_headers(etag, {"Content-Type":"application/pdf"})
 
 def _election_urls(itemid=None):
     if itemid is not None:
@@ -277,6 +530,9 @@ def _election_urls(itemid=None):
             "bubbles":url_for('election_bubblejson', itemid=itemid),
             "edit":url_for('edit', electionid=itemid),
             "post":url_for('elections', itemid=itemid),
+            "status":url_for('election_status', itemid=itemid),
+            # ?s=selector&s=..., or one style at style/by/<selector>.pdf or style/index/<n>.pdf
+            "styles":url_for('election_styles_pdf', itemid=itemid),
         }
     else:
         out = {
@@ -288,66 +544,438 @@ def _election_urls(itemid=None):
 @app.route("/election", methods=['POST'])
 def putNewElection():
     er = request.get_json()
-    bothob = _er_bothob(er)
     itemid = putelection(er)
-    mc().set('e{}'.format(itemid), bothob, time=3600)
+    _queue_render(itemid, er)
     return _election_urls(itemid), 200
 
 @app.route("/election/<int:itemid>", methods=['GET', 'POST'])
 def elections(itemid):
     if request.method == 'POST':
         er = request.get_json()
-        bothob = _er_bothob(er)
-        mc().set('e{}'.format(itemid), bothob, time=3600)
         itemid = putelection(er, itemid)
+        _queue_render(itemid, er)
         return _election_urls(itemid), 200
     elif request.method == 'GET':
-        er = getelection(itemid)
-        if er is None:
+        data = _getelectiondata(itemid, db())
+        if data is None:
             return {'error': 'no election {}'.format(itemid)}, 404
-        return er, 200
+        etag = hashlib.sha256(data.encode()).hexdigest()
+        if _not_modified(etag):
+            return '', 304, _cache_headers(etag)
+        # stored json as is
+        return data, 200, _cache_headers(etag, {"Content-Type":"application/json"})
     return 'nope', 400
 
-def _er_bothob(er):
+def _style_pdf(ep, i):
+    "pdf of just ballot style i, cached by BallotStyle.fingerprint() so edits to other styles don't invalidate it"
+    skey = 'bs{}'.format(ep.styleFingerprint(i))
+    srender = rc().get(skey) or {}
+    pdfbytes = srender.get('pdf')
+    if pdfbytes is not None:
+        return pdfbytes
+    return _renderFlight.do(skey, lambda: _style_pdf_render(ep, i, skey))
+
+def _style_pdf_render(ep, i, skey):
+    srender = rc().get(skey) or {}
+    if srender.get('pdf') is not None:
+        # finished while we waited to start
+        return srender['pdf']
+    out = io.BytesIO()
+    ep.drawStyle(i, out)
+    pdfbytes = out.getvalue()
+    app.logger.debug('rendered ballot style %d', i)
+    _count_rendered(ep, [i])
+    rc().set(skey, {'pdf':pdfbytes})
+    return pdfbytes
+
+def _er_bothob(er, progress=None):
     elections = er.get('Election', [])
     el = elections[0]
     ep = ElectionPrinter(er, el)
+    # one canvas for the whole election, contests shared between ballot styles are drawn once
     pdfbytes = io.BytesIO()
-    ep.drawToFile(outfile=pdfbytes)
+    ep.drawToFile(outfile=pdfbytes, progress=progress)
     pdfbytes = pdfbytes.getvalue()
+    _count_rendered(ep)
     return {'pdf':pdfbytes, 'bubbles':ep.getBubbles()}
 
-def _bothob_core(itemid):
+def _render_key(er):
+    return 'er{}'.format(draw.electionFingerprint(er))
+
+def _er_bothob_cached(er, progress=None, cachekey=None):
+    "{'pdf':, 'bubbles':} from the render cache, rendered and stored there if new content"
+    if cachekey is None:
+        cachekey = _render_key(er)
+    bothob = rc().get(cachekey)
+    if not bothob:
+        bothob = _renderFlight.do(cachekey, lambda: _er_bothob_render(er, cachekey, progress))
+    return bothob
+
+def _er_bothob_render(er, cachekey, progress=None):
+    bothob = rc().get(cachekey)
+    if bothob:
+        # finished while we waited to start
+        return bothob
+    with renderSeconds.time(endpoint=_render_endpoint()):
+        bothob = _er_bothob(er, progress)
+    rc().set(cachekey, bothob)
+    return bothob
+
+class RenderJob:
+    """Background render of a saved election, queued by _queue_render().
+    Saves of the election before it starts update it rather than queueing another.
+    Requests for its pdf/png/bubbles meanwhile wait on it through _renderFlight
+    (or render it themselves if it hasn't started, then it finds the result cached)."""
+    def __init__(self, itemid, er):
+        self.itemid = itemid
+        self.er = er
+        self.state = 'queued'
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.styles = len(er.get('Election', [{}])[0].get('BallotStyle', []))
+        self.stylesDone = 0
+        self.error = None
+
+    def run(self):
+        with _renderJobsLock:
+            # from here on a newer save queues a new job instead of updating this one
+            self.state = 'rendering'
+            er = self.er
+        self.started = time.time()
+        conn = pool().get()
+        try:
+            _election_bothob(self.itemid, er, conn, self.progress)
+            self.stylesDone = self.styles
+            self.state = 'done'
+        except Exception as e:
+            app.logger.error('background render of election %s failed', self.itemid, exc_info=True)
+            self.error = str(e)
+            self.state = 'error'
+        finally:
+            pool().put(conn)
+        self.finished = time.time()
+        self.er = None
+
+    def progress(self, done, total):
+        self.stylesDone = done
+        self.styles = total
+
+    def toJson(self):
+        return {
+            'itemid': self.itemid,
+            'state': self.state,
+            'queued': self.queued,
+            'started': self.started,
+            'finished': self.finished,
+            'styles': self.styles,
+            'stylesDone': self.stylesDone,
+            'error': self.error,
+        }
+
+_renderPool = None
+# {itemid: RenderJob} latest save of each election
+_renderJobs = {}
+_renderJobsLock = threading.Lock()
+# keep at most this many finished jobs for status
+MAX_RENDER_JOBS = 1000
+
+def _queue_render(itemid, er):
+    "render a just saved election in the background, on $BALLOTSTUDIO_RENDER_WORKERS threads (default 2)"
+    global _renderPool
+    with _renderJobsLock:
+        if _renderPool is None:
+            workers = int(os.getenv('BALLOTSTUDIO_RENDER_WORKERS') or 2)
+            _renderPool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        job = _renderJobs.get(itemid)
+        if (job is not None) and (job.state == 'queued'):
+            # one pending job per election, it renders the latest save when it starts
+            job.er = er
+            job.styles = len(er.get('Election', [{}])[0].get('BallotStyle', []))
+            return job
+        job = RenderJob(itemid, er)
+        _renderJobs[itemid] = job
+        if len(_renderJobs) > MAX_RENDER_JOBS:
+            finished = sorted([j for j in _renderJobs.values() if j.finished is not None], key=lambda j: j.finished)
+            for old in finished[:len(_renderJobs) - MAX_RENDER_JOBS]:
+                _renderJobs.pop(old.itemid, None)
+    _renderPool.submit(job.run)
+    return job
+
+@app.route("/election/<int:itemid>/status")
+def election_status(itemid):
+    "progress of the background render queued by the latest save"
+    job = _renderJobs.get(itemid)
+    if job is not None:
+        return job.toJson(), 200
     er = getelection(itemid)
     if er is None:
         return {'error': 'no election {}'.format(itemid)}, 404
-
-    cachekey = 'e{}'.format(itemid)
-    bothob = mc().get(cachekey)
-    if not bothob:
-        bothob = _er_bothob(er)
-        mc().set(cachekey, bothob, time=3600)
+    # nothing queued since this process started
+    state = 'done' if rc().get(_render_key(er)) else 'idle'
+    return {'itemid': itemid, 'state': state}, 200
+
+def _election_bothob(itemid, er, conn, progress=None, fingerprint=None):
+    """rendered saved election from the render cache, else its artifacts table rows, else rendered now.
+    A new render is written to the artifacts table so other processes and restarts can serve it."""
+    if fingerprint is None:
+        fingerprint = draw.electionFingerprint(er)
+    cachekey = 'er{}'.format(fingerprint)
+    bothob = rc().get(cachekey)
+    if bothob:
+        return bothob
+    pdfbytes = getartifact(conn, itemid, fingerprint, 'pdf')
+    bubbles = getartifact(conn, itemid, fingerprint, 'bubbles')
+    if (pdfbytes is not None) and (bubbles is not None):
+        bothob = {'pdf':pdfbytes, 'bubbles':json.loads(bubbles)}
+        rc().remember(cachekey, bothob)
+        return bothob
+    bothob = _er_bothob_cached(er, progress, cachekey)
+    putartifacts(conn, itemid, fingerprint, {'pdf':bothob['pdf'], 'bubbles':json.dumps(bothob['bubbles'])})
     return bothob
 
 @app.route("/election/<int:itemid>.pdf")
 def election_pdf(itemid):
-    bothob = _bothob_core(itemid)
-    pdfbytes = bothob['pdf']
-    return pdfbytes, 200, {"Content-Type":"application/pdf"}
+    data, fingerprint = _election_ref(itemid)
+    if data is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    if _not_modified(fingerprint):
+        return '', 304, _cache_headers(fingerprint)
+    headers = _cache_headers(fingerprint, {"Content-Type":"application/pdf"})
+    cachekey = 'er{}'.format(fingerprint)
+    bothob = rc().get(cachekey)
+    if bothob:
+        return bothob['pdf'], 200, headers
+    pdfbytes = getartifact(db(), itemid, fingerprint, 'pdf')
+    if pdfbytes is not None:
+        return pdfbytes, 200, headers
+    er = json.loads(data)
+    if requestbool('stream') and not _renderFlight.busy(cachekey):
+        # big elections: stream a render of our own straight out, keep nothing
+        el = er.get('Election', [])[0]
+        response = _pdf_stream(ElectionPrinter(er, el))
+        response.headers.update(_cache_headers(fingerprint))
+        return response
+    # rendered once however many requests and background jobs want it, stored for the rest
+    bothob = _election_bothob(itemid, er, db(), fingerprint=fingerprint)
+    return bothob['pdf'], 200, headers
 
 @app.route("/election/<int:itemid>.png")
 def election_png(itemid):
-    bothob = _bothob_core(itemid)
-    pngbytes = bothob.get('png')
+    "first page at default resolution"
+    data, fingerprint = _election_ref(itemid)
+    if data is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    if _not_modified(fingerprint):
+        return '', 304, _cache_headers(fingerprint)
+    pngbytes = _page_png(itemid, data, fingerprint, 1, raster.DEFAULT_DPI)
+    return pngbytes, 200, _cache_headers(fingerprint, {"Content-Type":"image/png"})
+
+@app.route("/election/<int:itemid>/page/<int:page>.png")
+def election_page_png(itemid, page):
+    "one page (1 based) at ?dpi= (default 150), rounded up to one of raster.DPI_TIERS"
+    data, fingerprint = _election_ref(itemid)
+    if data is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    dpi = raster.dpiTier(request.args.get('dpi', type=int))
+    etag = '{}-{}-{}'.format(fingerprint, page, dpi)
+    if _not_modified(etag):
+        return '', 304, _cache_headers(etag)
+    try:
+        pngbytes = _page_png(itemid, data, fingerprint, page, dpi)
+    except raster.PageRangeError:
+        return {'error': 'election {} has no page {}'.format(itemid, page)}, 404
+    return pngbytes, 200, _cache_headers(etag, {"Content-Type":"image/png"})
+
+@app.route("/election/<int:itemid>/page/<int:page>/thumb.png")
+def election_page_thumb(itemid, page):
+    "page preview ?w= pixels wide, rounded up to a thumbnail tier"
+    data, fingerprint = _election_ref(itemid)
+    if data is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    width = raster.thumbWidth(request.args.get('w', type=int))
+    etag = '{}-{}-w{}'.format(fingerprint, page, width)
+    if _not_modified(etag):
+        return '', 304, _cache_headers(etag)
+    cachekey = 'th{}-{}'.format(fingerprint, page)
+    try:
+        thumbs = _thumbs(cachekey, lambda: _page_png(itemid, data, fingerprint, page, raster.THUMB_DPI))
+    except raster.PageRangeError:
+        return {'error': 'election {} has no page {}'.format(itemid, page)}, 404
+    return thumbs[width], 200, _cache_headers(etag, {"Content-Type":"image/png"})
+
+@app.route("/election/<int:itemid>/style/index/<int:index>/thumb.png")
+def election_style_thumb(itemid, index):
+    "first page of one ballot style ?w= pixels wide, e.g. for a ballot style picker"
+    data, fingerprint = _election_ref(itemid)
+    if data is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    width = raster.thumbWidth(request.args.get('w', type=int))
+    etag = '{}-s{}-w{}'.format(fingerprint, index, width)
+    if _not_modified(etag):
+        return '', 304, _cache_headers(etag)
+    er = json.loads(data)
+    ep = ElectionPrinter(er, er.get('Election', [])[0])
+    if not (0 <= index < len(ep.ballot_styles)):
+        return {'error': 'election {} has no ballot style {}'.format(itemid, index)}, 404
+    # keyed by the style's own content, survives edits to other styles
+    cachekey = 'th{}'.format(ep.styleFingerprint(index))
+    thumbs = _thumbs(cachekey, lambda: pdfToPng(_style_pdf(ep, index), 1, raster.THUMB_DPI))
+    return thumbs[width], 200, _cache_headers(etag, {"Content-Type":"image/png"})
+
+def _thumbs(cachekey, sourcefn):
+    "{width: png} for every thumbnail tier, made together from one sourcefn() page raster and kept in rc()"
+    thumbs = rc().get(cachekey)
+    if thumbs is None:
+        thumbs = _renderFlight.do(cachekey, lambda: _thumbs_render(cachekey, sourcefn))
+    return thumbs
+
+def _thumbs_render(cachekey, sourcefn):
+    thumbs = rc().get(cachekey)
+    if thumbs is None:
+        thumbs = raster.thumbnails(sourcefn())
+        rc().set(cachekey, thumbs)
+    return thumbs
+
+def _page_png(itemid, data, fingerprint, page, dpi):
+    """png of a page of a saved election, from mc(), else the artifacts table, else rasterized.
+    Only the default resolution is stored in the artifacts table, other tiers just in mc()."""
+    cachekey = 'png{}-{}-{}'.format(fingerprint, page, dpi)
+    pngbytes = mc().get(cachekey)
+    if pngbytes is None:
+        pngbytes = _renderFlight.do(cachekey, lambda: _page_png_render(itemid, data, fingerprint, page, dpi, cachekey))
+    return pngbytes
+
+def _page_png_render(itemid, data, fingerprint, page, dpi, cachekey):
+    pngbytes = mc().get(cachekey)
+    if pngbytes is not None:
+        # finished while we waited to start
+        return pngbytes
+    kind = 'png{}'.format(dpi)
+    pngbytes = getartifact(db(), itemid, fingerprint, kind, page)
     if pngbytes is None:
-        pngbytes = pdfToPng(bothob['pdf'])
-        bothob['png'] = pngbytes
-    return pngbytes, 200, {"Content-Type":"image/png"}
+        bothob = _election_bothob(itemid, json.loads(data), db(), fingerprint=fingerprint)
+        pngbytes = pdfToPng(bothob['pdf'], page, dpi)
+        if dpi == raster.DEFAULT_DPI:
+            putartifacts(db(), itemid, fingerprint, {(kind, page):pngbytes})
+    mc().set(cachekey, pngbytes, time=3600)
+    return pngbytes
+
+def _bubbles_core(itemid, er, fingerprint):
+    "bubbles from a cached render if there is one, otherwise from layout alone without drawing a pdf"
+    bothob = rc().get('er{}'.format(fingerprint))
+    if bothob:
+        return bothob['bubbles']
+    bubbles = getartifact(db(), itemid, fingerprint, 'bubbles')
+    if bubbles is not None:
+        return json.loads(bubbles)
+    cachekey = 'b{}'.format(fingerprint)
+    bubbles = mc().get(cachekey)
+    if bubbles:
+        return bubbles
+    elections = er.get('Election', [])
+    el = elections[0]
+    ep = ElectionPrinter(er, el)
+    bubbles = ep.getBubbles()
+    mc().set(cachekey, bubbles, time=3600)
+    return bubbles
 
 @app.route("/election/<int:itemid>_bubbles.json")
 def election_bubblejson(itemid):
-    bothob = _bothob_core(itemid)
-    return bothob['bubbles'], 200 # implicit dict-to-json return
+    data, fingerprint = _election_ref(itemid)
+    if data is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    if _not_modified(fingerprint):
+        return '', 304, _cache_headers(fingerprint)
+    bubbles = _bubbles_core(itemid, json.loads(data), fingerprint)
+    return bubbles, 200, _cache_headers(fingerprint) # implicit dict-to-json return
+
+def _election_printer(itemid):
+    er = getelection(itemid)
+    if er is None:
+        return None
+    elections = er.get('Election', [])
+    el = elections[0]
+    return ElectionPrinter(er, el)
+
+@app.route("/election/<int:itemid>/style/index/<int:index>.pdf")
+def election_style_pdf(itemid, index):
+    "one ballot style by its index in Election.BallotStyle"
+    ep = _election_printer(itemid)
+    if ep is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    if not (0 <= index < len(ep.ballot_styles)):
+        return {'error': 'election {} has no ballot style {}'.format(itemid, index)}, 404
+    pdfbytes = _style_pdf(ep, index)
+    return pdfbytes, 200, {"Content-Type":"application/pdf"}
+
+@app.route("/election/<int:itemid>/style/by/<selector>.pdf")
+def election_selector_pdf(itemid, selector):
+    "ballot style(s) by GpUnit @id or ExternalIdentifier"
+    return _selected_pdf(itemid, [selector])
+
+@app.route("/election/<int:itemid>/styles.pdf")
+def election_styles_pdf(itemid):
+    "ballot styles matching any of ?s=selector&s=..."
+    return _selected_pdf(itemid, request.args.getlist('s'))
+
+def _selected_pdf(itemid, selectors):
+    ep = _election_printer(itemid)
+    if ep is None:
+        return {'error': 'no election {}'.format(itemid)}, 404
+    indexes = [i for i, bs in enumerate(ep.ballot_styles) if bs.select(selectors)]
+    if not indexes:
+        return {'error': 'election {} has no ballot style for {!r}'.format(itemid, selectors)}, 404
+    if len(indexes) == 1:
+        pdfbytes = _style_pdf(ep, indexes[0])
+        return pdfbytes, 200, {"Content-Type":"application/pdf"}
+    # keyed by the selected styles' content, so edits elsewhere in the election don't invalidate it
+    fingerprints = ' '.join([ep.styleFingerprint(i) for i in indexes])
+    cachekey = 'bss{}'.format(hashlib.sha256(fingerprints.encode()).hexdigest())
+    pdfbytes = rc().get(cachekey)
+    if pdfbytes is None:
+        pdfbytes = _renderFlight.do(cachekey, lambda: _selected_pdf_render(ep, indexes, selectors, cachekey))
+    return pdfbytes, 200, {"Content-Type":"application/pdf"}
+
+def _selected_pdf_render(ep, indexes, selectors, cachekey):
+    pdfbytes = rc().get(cachekey)
+    if pdfbytes is None:
+        out = io.BytesIO()
+        with renderSeconds.time(endpoint=_render_endpoint()):
+            ep.drawToFile(outfile=out, selectors=selectors)
+        pdfbytes = out.getvalue()
+        _count_rendered(ep, indexes)
+        rc().set(cachekey, pdfbytes)
+    return pdfbytes
+
+@metrics.collector
+def _cache_metrics():
+    caches = []
+    if memcache is None and _cache is not None:
+        caches.append(('mc', _cache))
+    if _renderCache is not None:
+        caches.append(('render', _renderCache.memory))
+        if _renderCache.disk is not None:
+            caches.append(('render_disk', _renderCache.disk))
+    out = []
+    for name, mtype, help, attr in [
+            ('ballotstudio_cache_hits_total', 'counter', 'cache gets that found a value', 'hits'),
+            ('ballotstudio_cache_misses_total', 'counter', 'cache gets that found nothing', 'misses'),
+            ('ballotstudio_cache_evictions_total', 'counter', 'items evicted to stay under the byte budget', 'evictions'),
+            ('ballotstudio_cache_bytes', 'gauge', 'approximate bytes held', 'nbytes')]:
+        samples = []
+        for cname, cob in caches:
+            samples.append(({'cache':cname}, getattr(cob, attr)))
+        out.append((name, mtype, help, samples))
+    return out
+
+@metrics.collector
+def _flight_metrics():
+    return [('ballotstudio_render_coalesced_total', 'counter', 'requests that waited on an identical render already running', [({}, _renderFlight.shared)])]
+
+@app.route("/metrics")
+def metricsHandler():
+    return metrics.exposition(), 200, {"Content-Type":"text/plain; version=0.0.4"}
 
 @app.route("/election/<int:electionid>/scan")
 def scanform(electionid):
@@ -1,17 +1,57 @@
 #!/usr/bin/env python3
 
+import collections
+import hashlib
+import heapq
+import logging
+import os
+import pickle
 import threading
 import time
 
+logger = logging.getLogger(__name__)
+
 now = time.time
 
 class meta:
-    def __init__(self, ttl=None):
+    def __init__(self, ttl=None, size=0):
         self.ttl = ttl
+        self.size = size
+
+def approxSize(value):
+    "rough bytes held by value, counting bytes and str payloads of nested dicts, lists and tuples"
+    total = 0
+    stack = [value]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, (bytes, bytearray, str)):
+            total += len(x) + 50
+        elif isinstance(x, dict):
+            total += 64 + 16 * len(x)
+            stack.extend(x.keys())
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple)):
+            total += 56 + 8 * len(x)
+            stack.extend(x)
+        else:
+            total += 32
+    return total
 
 class Cache:
-    def __init__(self):
-        self.items = {}
+    """In process key-value cache with per-item TTL.
+    With maxBytes, least recently used items are evicted to keep approxSize() of all values under it.
+    Expired items are found through a heap of expiry times, not by scanning every key."""
+    def __init__(self, maxBytes=None):
+        self.maxBytes = maxBytes
+        # {key: (meta, value)}, least recently used first
+        self.items = collections.OrderedDict()
+        # [(expire time, seq, key, meta), ...] entries are stale if items[key] has a different meta
+        self.expiry = []
+        self.seq = 0
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         self.lock = threading.Lock()
         self.closer = threading.Condition(self.lock)
         self.t = threading.Thread(target=self.gcThread)
@@ -24,8 +64,24 @@ class Cache:
         self.t.join(1)
 
     def set(self, key, value, time=None):
+        size = approxSize(value)
+        m = meta(None if time is None else now() + time, size)
         with self.lock:
-            self.items[key] = (meta(now() + time), value)
+            self._pop(key)
+            if (self.maxBytes is not None) and (size > self.maxBytes):
+                # would evict everything else and still not fit
+                return
+            self.items[key] = (m, value)
+            self.nbytes += size
+            if m.ttl is not None:
+                self.seq += 1
+                heapq.heappush(self.expiry, (m.ttl, self.seq, key, m))
+            self._expire(now())
+            if self.maxBytes is not None:
+                while self.nbytes > self.maxBytes:
+                    k, (om, ov) = self.items.popitem(last=False)
+                    self.nbytes -= om.size
+                    self.evictions += 1
 
     def get(self, key):
         with self.lock:
@@ -33,9 +89,32 @@ class Cache:
             if mv:
                 m, v = mv
                 if (m.ttl is None) or (m.ttl > now()):
+                    self.items.move_to_end(key)
+                    self.hits += 1
                     return v
+                self._pop(key)
+            self.misses += 1
             return None
 
+    def _pop(self, key):
+        # with lock held
+        mv = self.items.pop(key, None)
+        if mv is not None:
+            self.nbytes -= mv[0].size
+        return mv
+
+    def _expire(self, t):
+        # with lock held
+        while self.expiry and (self.expiry[0][0] <= t):
+            _, _, k, m = heapq.heappop(self.expiry)
+            mv = self.items.get(k)
+            if (mv is not None) and (mv[0] is m):
+                self._pop(k)
+        if len(self.expiry) > 2 * len(self.items) + 64:
+            # mostly stale entries for keys set again or evicted, rebuild
+            self.expiry = [e for e in self.expiry if (e[2] in self.items) and (self.items[e[2]][0] is e[3])]
+            heapq.heapify(self.expiry)
+
     def gcThread(self):
         self.closer.acquire()
         while True:
@@ -43,13 +122,169 @@ class Cache:
                 # got close
                 self.closer.release()
                 return
+            # do garbage collection, closer holds the lock
+            self._expire(now())
+
+
+class _call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesce concurrent work on the same key.
+    do(key, fn) runs fn() if nothing is running for key, otherwise waits for the running call and shares its result."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {key: _call}
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.value
+
+    def busy(self, key):
+        "something is running for key now"
+        with self.lock:
+            return key in self.calls
+
+class DiskCache:
+    """One pickle file per key under a directory, survives restarts.
+    Past maxBytes the least recently used files (by mtime, touched on get) are removed."""
+    def __init__(self, path, maxBytes=512*1024*1024):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # {fname: size}
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._scan()
+
+    def _scan(self):
+        sizes = {}
+        for fname in os.listdir(self.path):
+            if not fname.endswith('.pickle'):
+                continue
+            try:
+                sizes[fname] = os.stat(os.path.join(self.path, fname)).st_size
+            except OSError:
+                pass
+        self.sizes = sizes
+        self.nbytes = sum(sizes.values())
+
+    def _fname(self, key):
+        return hashlib.sha256(key.encode()).hexdigest() + '.pickle'
+
+    def get(self, key):
+        fpath = os.path.join(self.path, self._fname(key))
+        try:
+            with open(fpath, 'rb') as fin:
+                value = pickle.load(fin)
+            os.utime(fpath)
+            self.hits += 1
+            return value
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning('bad disk cache entry %s: %s', fpath, e)
+            self._remove(self._fname(key))
+            return None
+
+    def set(self, key, value):
+        fname = self._fname(key)
+        fpath = os.path.join(self.path, fname)
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        tmppath = '{}.{}.{}.tmp'.format(fpath, os.getpid(), threading.get_ident())
+        with open(tmppath, 'wb') as fout:
+            fout.write(blob)
+        os.replace(tmppath, fpath)
+        with self.lock:
+            self.nbytes += len(blob) - self.sizes.get(fname, 0)
+            self.sizes[fname] = len(blob)
+            if self.nbytes > self.maxBytes:
+                self._evict()
+
+    def _remove(self, fname):
+        try:
+            os.remove(os.path.join(self.path, fname))
+        except OSError:
+            pass
+        with self.lock:
+            self.nbytes -= self.sizes.pop(fname, 0)
+
+    def _evict(self):
+        # other processes may share the directory, start from what is really there
+        self._scan()
+        if self.nbytes <= self.maxBytes:
+            return
+        byage = []
+        for fname in self.sizes:
+            try:
+                byage.append((os.stat(os.path.join(self.path, fname)).st_mtime, fname))
+            except OSError:
+                pass
+        byage.sort()
+        for _, fname in byage:
+            if self.nbytes <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, fname))
+            except OSError:
+                pass
+            self.nbytes -= self.sizes.pop(fname, 0)
+            self.evictions += 1
+
+class RenderCache:
+    """Content addressed cache of rendered elections, memory tier in front of an optional DiskCache.
+    Keys are fingerprints of what was rendered, including draw.RENDER_VERSION, so a change to the
+    election, Settings or drawing code misses instead of serving an old render."""
+    def __init__(self, path=None, maxBytes=512*1024*1024, ttl=3600, memoryBytes=None):
+        self.memory = Cache(memoryBytes)
+        self.disk = None
+        if path:
+            self.disk = DiskCache(path, maxBytes)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if (value is None) and (self.disk is not None):
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value, time=self.ttl)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value, time=self.ttl)
+        if self.disk is not None:
+            self.disk.set(key, value)
 
-            # do garbage collection
-            t = now()
-            todel = []
-            for k,mv in self.items.items():
-                m,v = mv
-                if m.ttl and (m.ttl < t):
-                    todel.append(k)
-            for k in todel:
-                self.items.pop(k)
+    def remember(self, key, value):
+        "memory tier only, for values already stored somewhere durable"
+        self.memory.set(key, value, time=self.ttl)
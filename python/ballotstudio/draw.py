@@ -2,18 +2,23 @@
 # -*- mode: Python; coding: utf-8 -*-
 #
 
+import collections
+import concurrent.futures
+import copy
 import glob
 import gzip
-import io
+import hashlib
 import json
 import logging
 import os
 import time
 import statistics
 import sys
+import threading
 
 from PIL import Image
 import fontTools.ttLib
+import reportlab
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.lib.units import inch, mm, cm
@@ -32,13 +37,24 @@ class TodoException(Exception):
 
 
 class Bfont:
-    def __init__(self, path, name=None):
+    def __init__(self, path, name=None, capHeightPerPt=None):
         self.name = name
         self.path = path
-        self.capHeightPerPt = None
-        self._measureCapheight()
-        lfont = TTFont(self.name, self.path)
-        pdfmetrics.registerFont(lfont)
+        self.capHeightPerPt = capHeightPerPt
+        self.registered = False
+        if (self.name is None) or (self.capHeightPerPt is None):
+            self._measureCapheight()
+
+    def register(self):
+        "register with reportlab pdfmetrics, parses the whole font, only do it for fonts actually used"
+        if not self.registered:
+            lfont = TTFont(self.name, self.path)
+            pdfmetrics.registerFont(lfont)
+            self.registered = True
+
+    def metrics(self, st):
+        "json for font metrics cache"
+        return {'mtime':st.st_mtime, 'size':st.st_size, 'name':self.name, 'capHeightPerPt':self.capHeightPerPt}
 
     def _measureCapheight(self):
         ftt = fontTools.ttLib.TTFont(self.path)
@@ -62,15 +78,92 @@ for mayber in (os.path.join(os.getcwd(), 'resources'), os.path.join(os.path.dirn
     if os.path.isdir(mayber):
         resources = mayber
         break
+def _renderVersion():
+    "hash of this module's source and the reportlab version; any change to layout or drawing code changes it"
+    h = hashlib.sha256(reportlab.Version.encode())
+    with open(__file__, 'rb') as fin:
+        h.update(fin.read())
+    return h.hexdigest()[:16]
+
+# part of every render fingerprint, so cached layouts, pdfs and bubble coordinates from other code don't get served
+RENDER_VERSION = _renderVersion()
+
 fonts = {}
+_fonts_lock = threading.Lock()
 
-def _ensure_fonts():
-    if not fonts:
-        for fpath in glob.glob('/usr/share/fonts/truetype/liberation/*.ttf') + glob.glob(os.path.join(resources,'*.ttf')):
+def _fontMetricsCachePath():
+    "$BALLOTSTUDIO_FONT_CACHE, empty string disables, default ~/.cache/ballotstudio/fontmetrics.json"
+    path = os.getenv('BALLOTSTUDIO_FONT_CACHE')
+    if path is not None:
+        return path or None
+    return os.path.join(os.path.expanduser('~'), '.cache', 'ballotstudio', 'fontmetrics.json')
+
+def _loadFontMetrics(path):
+    try:
+        with open(path, 'rt') as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+def _saveFontMetrics(path, metrics):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmppath, 'wt') as fout:
+            json.dump(metrics, fout)
+        os.replace(tmppath, path)
+    except OSError as e:
+        logger.warning('could not write font metrics cache %s: %s', path, e)
+
+def _loadFonts():
+    "{name: Bfont} for the fonts we ship or find installed, metrics from the cache where the file is unchanged"
+    # {font file path: {"mtime":, "size":, "name":, "capHeightPerPt":}, ...}
+    cachepath = _fontMetricsCachePath()
+    cached = {}
+    if cachepath:
+        cached = _loadFontMetrics(cachepath)
+    metrics = {}
+    loaded = {}
+    for fpath in glob.glob('/usr/share/fonts/truetype/liberation/*.ttf') + glob.glob(os.path.join(resources,'*.ttf')):
+        st = os.stat(fpath)
+        fm = cached.get(fpath)
+        if fm and (fm.get('mtime') == st.st_mtime) and (fm.get('size') == st.st_size):
+            xf = Bfont(fpath, fm['name'], fm['capHeightPerPt'])
+        else:
             xf = Bfont(fpath)
-            fonts[xf.name] = xf
+        metrics[fpath] = xf.metrics(st)
+        loaded[xf.name] = xf
+    if cachepath and (metrics != cached):
+        _saveFontMetrics(cachepath, metrics)
+    logger.info('fonts: ' + ', '.join([repr(n) for n in loaded.keys()]))
+    return loaded
 
-        logger.info('fonts: ' + ', '.join([repr(n) for n in fonts.keys()]))
+# set last, after fonts is fully populated; readers that see it True need no lock
+_fonts_loaded = False
+
+def _ensure_fonts():
+    "load font metrics once. Fonts are registered with reportlab by ensureFont() where they are first drawn."
+    global _fonts_loaded
+    if not _fonts_loaded:
+        with _fonts_lock:
+            if not _fonts_loaded:
+                fonts.update(_loadFonts())
+                _fonts_loaded = True
+
+def ensureFont(name):
+    "register a font by name on first use, return Bfont or None if it isn't one of ours"
+    _ensure_fonts()
+    xf = fonts.get(name)
+    if (xf is not None) and not xf.registered:
+        with _fonts_lock:
+            if not xf.registered:
+                xf.register()
+    return xf
+
+def _font(name):
+    "ensureFont(name), return name for setFont()"
+    ensureFont(name)
+    return name
 
 fontsans = 'Liberation Sans'
 fontsansbold = 'Liberation Sans Bold'
@@ -162,6 +255,56 @@ pageHeaderNumberStyle = ParagraphStyle(
     leading=gs.headerLeading * 1.9,
 )
 
+class MeasureCache:
+    """Process-wide memo of wrapped Paragraph objects.
+
+    Keyed by (text, ParagraphStyle, available width). Styles are compared by
+    identity, they're module level constants here. Bounded LRU.
+    """
+    def __init__(self, maxsize=20000):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def _get(self, text, style, width):
+        key = (text, style, width)
+        with self.lock:
+            ent = self.items.get(key)
+            if ent is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return ent
+        ensureFont(style.fontName)
+        par = Paragraph(text, style)
+        ww, wh = par.wrap(width, 100)
+        ent = (par, ww, wh)
+        with self.lock:
+            self.misses += 1
+            self.items[key] = ent
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        return ent
+    def size(self, text, style, width):
+        "return (width, height) of text wrapped to width"
+        _, ww, wh = self._get(text, style, width)
+        return ww, wh
+    def paragraph(self, text, style, width):
+        "return (Paragraph, width, height), Paragraph already wrapped and ready for drawOn()"
+        par, ww, wh = self._get(text, style, width)
+        # drawOn() sets par.canv, don't share that between threads
+        return copy.copy(par), ww, wh
+    def stats(self):
+        with self.lock:
+            return {'hits':self.hits, 'misses':self.misses, 'size':len(self.items), 'maxsize':self.maxsize}
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+measureCache = MeasureCache()
+
 def setOptionalFields(self, ob):
     for field_name, default_value in self._optional_fields:
         setattr(self, field_name, ob.get(field_name, default_value))
@@ -187,6 +330,14 @@ _votevariation_instruction_en = {
     "n-of-m": "Vote for up to {VotesAllowed}",
 }
 
+def bubbleCoords(x, y):
+    "(left, bottom, width, height) of the bubble for a selection drawn at x,y"
+    capHeight = ensureFont(gs.candidateFontName).capHeightPerPt * gs.candidateFontSize
+    bubbleHeight = min(3*mm, capHeight)
+    bubbleYShim = (capHeight - bubbleHeight) / 2.0
+    bubbleBottom = y - gs.candidateFontSize + bubbleYShim
+    return (x + gs.bubbleLeftPad, bubbleBottom, gs.bubbleWidth, bubbleHeight)
+
 class BallotMeasureSelection:
     "NIST 1500-100 v2 ElectionResults.BallotMeasureSelection"
     _optional_fields = (
@@ -200,16 +351,13 @@ class BallotMeasureSelection:
         self.atid = self.cs['@id']
         self.selection = self.cs['Selection']
         setOptionalFields(self, self.cs)
-        self._bubbleCoords = None
     def height(self, width):
         out = gs.candidateLeading
         out += 0.1 * inch
         return out
+    def bubbleCoords(self, x, y):
+        return bubbleCoords(x, y)
     def draw(self, c, x, y, width):
-        capHeight = fonts[gs.candidateFontName].capHeightPerPt * gs.candidateFontSize
-        bubbleHeight = min(3*mm, capHeight)
-        bubbleYShim = (capHeight - bubbleHeight) / 2.0
-        bubbleBottom = y - gs.candidateFontSize + bubbleYShim
         c.setStrokeColorRGB(0,0,0)
         c.setLineWidth(1)
         rrFill = 0
@@ -218,13 +366,12 @@ class BallotMeasureSelection:
             rrFill = 1
         else:
             c.setFillColorRGB(1,1,1)
-        self._bubbleCoords = (x + gs.bubbleLeftPad, bubbleBottom, gs.bubbleWidth, bubbleHeight)
-        c.roundRect(*self._bubbleCoords, radius=bubbleHeight/2, fill=rrFill)
+        bubble = bubbleCoords(x, y)
+        c.roundRect(*bubble, radius=bubble[3]/2, fill=rrFill)
         clo = gs.bubbleLeftPad + gs.bubbleWidth + gs.bubbleRightPad
         textx = x + clo #gs.bubbleLeftPad + gs.bubbleWidth + gs.bubbleRightPad
         c.setFillColorRGB(0,0,0)
-        cpar = Paragraph(self.selection, selectionStyle)
-        ww, wh = cpar.wrap(width - clo, 100)
+        cpar, ww, wh = measureCache.paragraph(self.selection, selectionStyle, width - clo)
         cpar.drawOn(c, textx, y-wh)
         ypos = y - wh
         # separator line
@@ -270,7 +417,6 @@ class CandidateSelection:
             self.subtext = ', '.join(peopleparties)
         else:
             self.subtext = None
-        self._bubbleCoords = None
     def height(self, width):
         # TODO: actually check render for width with party and subtitle and all that
         # out = gs.candidateLeading * len(self.candidates)
@@ -278,12 +424,10 @@ class CandidateSelection:
         ballotName = self.ballotName()
         clo = gs.bubbleLeftPad + gs.bubbleWidth + gs.bubbleRightPad
         if ballotName:
-            cpar = Paragraph(ballotName, selectionStyle)
-            ww, wh = cpar.wrap(width - clo, 100)
+            ww, wh = measureCache.size(ballotName, selectionStyle, width - clo)
             out += wh
         if self.subtext:
-            cpar = Paragraph(self.subtext, selsubStyle)
-            ww, wh = cpar.wrap(width - clo, 100)
+            ww, wh = measureCache.size(self.subtext, selsubStyle, width - clo)
             out += wh
         if self.IsWriteIn:
             out += gs.candsubLeading
@@ -300,11 +444,9 @@ class CandidateSelection:
             if ballotName is None:
                 ballotName = 'error: Ballot Name is required in csel for {}'.format(' '.join(self.CandidateIds))
         return ballotName
+    def bubbleCoords(self, x, y):
+        return bubbleCoords(x, y)
     def draw(self, c, x, y, width):
-        capHeight = fonts[gs.candidateFontName].capHeightPerPt * gs.candidateFontSize
-        bubbleHeight = min(3*mm, capHeight)
-        bubbleYShim = (capHeight - bubbleHeight) / 2.0
-        bubbleBottom = y - gs.candidateFontSize + bubbleYShim
         c.setStrokeColorRGB(0,0,0)
         c.setLineWidth(1)
         rrFill = 0
@@ -313,8 +455,8 @@ class CandidateSelection:
             rrFill = 1
         else:
             c.setFillColorRGB(1,1,1)
-        self._bubbleCoords = (x + gs.bubbleLeftPad, bubbleBottom, gs.bubbleWidth, bubbleHeight)
-        c.roundRect(*self._bubbleCoords, radius=bubbleHeight/2, fill=rrFill)
+        bubble = bubbleCoords(x, y)
+        c.roundRect(*bubble, radius=bubble[3]/2, fill=rrFill)
         clo = gs.bubbleLeftPad + gs.bubbleWidth + gs.bubbleRightPad
         textx = x + clo # gs.bubbleLeftPad + gs.bubbleWidth + gs.bubbleRightPad
         # TODO: assumes one line
@@ -322,18 +464,16 @@ class CandidateSelection:
         ballotName = self.ballotName()
         ypos = y
         if ballotName:
-            cpar = Paragraph(ballotName, selectionStyle)
-            ww, wh = cpar.wrap(width - clo, 100)
+            cpar, ww, wh = measureCache.paragraph(ballotName, selectionStyle, width - clo)
             cpar.drawOn(c, textx, ypos-wh)
             ypos -= wh
         if self.subtext:
-            cpar = Paragraph(self.subtext, selsubStyle)
-            ww, wh = cpar.wrap(width - clo, 100)
+            cpar, ww, wh = measureCache.paragraph(self.subtext, selsubStyle, width - clo)
             cpar.drawOn(c, textx, ypos-wh)
             ypos -= wh
         if self.IsWriteIn:
             txto = c.beginText(textx, ypos - gs.candsubFontSize)
-            txto.setFont(gs.candsubFontName, gs.candsubFontSize, leading=gs.candsubLeading)
+            txto.setFont(_font(gs.candsubFontName), gs.candsubFontSize, leading=gs.candsubLeading)
             txto.textLines('write-in:')
             c.drawText(txto)
             ypos -= gs.candsubLeading
@@ -383,13 +523,14 @@ class BallotMeasureContest:
         self.ElectionDistrictId = co['ElectionDistrictId'] # reference to a ReportingUnit gpunit
         setOptionalFields(self, self.co)
         self.draw_selections = [erctx.makeDrawOb(x) for x in self.ContestSelection]
+        # {selection @id: json ob} for OrderedContestSelectionIds
+        self.selectionsById = {x['@id']:x for x in self.ContestSelection}
     def draw(self, c, x, y, width, draw_selections=None):
         if draw_selections is None:
             draw_selections = self.draw_selections
         pos = y - 3 # leave room for 3pt top border
         # title
-        tpar = Paragraph(self.BallotTitle, contestTitleStyle)
-        ww, wh = tpar.wrap(width, 100)
+        tpar, ww, wh = measureCache.paragraph(self.BallotTitle, contestTitleStyle, width)
         c.setStrokeColorRGB(*gs.titleBGColor)
         c.setFillColorRGB(*gs.titleBGColor)
         c.rect(x, pos - wh, width, wh, fill=1, stroke=0)
@@ -403,7 +544,7 @@ class BallotMeasureContest:
         c.setStrokeColorRGB(0,0,0)
         # TODO: skip BallotSubTitle if null/empty
         txto = c.beginText(x + 1 + (0.1 * inch), pos - gs.subtitleFontSize)
-        txto.setFont(gs.subtitleFontName, gs.subtitleFontSize)
+        txto.setFont(_font(gs.subtitleFontName), gs.subtitleFontSize)
         txto.textLines(self.BallotSubTitle or '')
         c.drawText(txto)
         pos -= gs.subtitleLeading
@@ -411,11 +552,9 @@ class BallotMeasureContest:
         c.setStrokeColorRGB(0,0,0)
         # TODO SummaryText
         pos -= 0.1 * inch # header-choice gap
-        maxheight = self._maxheight(width-1)
-        for ds in draw_selections:
-            dy = ds.height(width)
-            ds.draw(c, x+1, pos, width-1)
-            pos -= maxheight
+        tops, pos = self._selectionTops(pos, width, draw_selections)
+        for ds, dtop in tops:
+            ds.draw(c, x+1, dtop, width-1)
         pos -= 0.1 * inch # bottom padding
 
         # top border
@@ -430,6 +569,28 @@ class BallotMeasureContest:
         path.lineTo(x+width, pos-0.5)
         c.drawPath(path, stroke=1)
         return
+    def _selectionsTop(self, y, width):
+        "below top border, title, subtitle and gap; where the first selection goes"
+        pos = y - 3
+        _, wh = measureCache.size(self.BallotTitle, contestTitleStyle, width)
+        pos -= wh
+        pos -= gs.subtitleLeading
+        pos -= 0.1 * inch # header-choice gap
+        return pos
+    def _selectionTops(self, pos, width, draw_selections):
+        "return [(selection, top y), ...], bottom y"
+        maxheight = self._maxheight(width-1)
+        tops = []
+        for ds in draw_selections:
+            tops.append((ds, pos))
+            pos -= maxheight
+        return tops, pos
+    def bubbles(self, x, y, width, draw_selections=None):
+        "{selection @id: (left, bottom, width, height), ...} for contest drawn at x,y"
+        if draw_selections is None:
+            draw_selections = self.draw_selections
+        tops, _ = self._selectionTops(self._selectionsTop(y, width), width, draw_selections)
+        return {ds.atid:ds.bubbleCoords(x+1, dtop) for ds, dtop in tops}
     def _maxheight(self, width, draw_selections=None):
         draw_selections = draw_selections or self.draw_selections
         mh = None
@@ -444,8 +605,7 @@ class BallotMeasureContest:
         draw_selections = draw_selections or self.draw_selections
         out = self._maxheight(width-1) * len(draw_selections)
         out += 4 # top and bottom border
-        tpar = Paragraph(self.BallotTitle, contestTitleStyle)
-        _, wh = tpar.wrap(width, 100)
+        _, wh = measureCache.size(self.BallotTitle, contestTitleStyle, width)
         out += wh + gs.subtitleLeading
         out += 0.1 * inch # header-choice gap
         out += 0.1 * inch # bottom padding
@@ -485,13 +645,14 @@ class CandidateContest:
         else:
             self.offices = []
         self.draw_selections = [erctx.makeDrawOb(x) for x in self.ContestSelection]
+        # {selection @id: json ob} for OrderedContestSelectionIds
+        self.selectionsById = {x['@id']:x for x in self.ContestSelection}
     def draw(self, c, x, y, width, draw_selections=None):
         if draw_selections is None:
             draw_selections = self.draw_selections
         pos = y - 3 # leave room for 3pt top border
         # title
-        tpar = Paragraph(self.BallotTitle, contestTitleStyle)
-        ww, wh = tpar.wrap(width, 100)
+        tpar, ww, wh = measureCache.paragraph(self.BallotTitle, contestTitleStyle, width)
         c.setStrokeColorRGB(*gs.titleBGColor)
         c.setFillColorRGB(*gs.titleBGColor)
         c.rect(x, pos - wh, width, wh, fill=1, stroke=0)
@@ -504,18 +665,16 @@ class CandidateContest:
         c.setFillColorRGB(0,0,0)
         c.setStrokeColorRGB(0,0,0)
         txto = c.beginText(x + 1 + (0.1 * inch), pos - gs.subtitleFontSize)
-        txto.setFont(gs.subtitleFontName, gs.subtitleFontSize)
+        txto.setFont(_font(gs.subtitleFontName), gs.subtitleFontSize)
         txto.textLines(self.BallotSubTitle)
         c.drawText(txto)
         pos -= gs.subtitleLeading
         pos -= 0.1 * inch # header-choice gap
         c.setFillColorRGB(0,0,0)
         c.setStrokeColorRGB(0,0,0)
-        maxheight = self._maxheight(width-1, draw_selections)
-        for ds in draw_selections:
-            dy = ds.height(width)
-            ds.draw(c, x+1, pos, width-1)
-            pos -= max(maxheight,dy)
+        tops, pos = self._selectionTops(pos, width, draw_selections)
+        for ds, dtop in tops:
+            ds.draw(c, x+1, dtop, width-1)
         pos -= 0.1 * inch # bottom padding
 
         # top border
@@ -530,6 +689,29 @@ class CandidateContest:
         path.lineTo(x+width, pos-0.5)
         c.drawPath(path, stroke=1)
         return
+    def _selectionsTop(self, y, width):
+        "below top border, title, subtitle and gap; where the first selection goes"
+        pos = y - 3
+        _, wh = measureCache.size(self.BallotTitle, contestTitleStyle, width)
+        pos -= wh
+        pos -= gs.subtitleLeading
+        pos -= 0.1 * inch # header-choice gap
+        return pos
+    def _selectionTops(self, pos, width, draw_selections):
+        "return [(selection, top y), ...], bottom y"
+        maxheight = self._maxheight(width-1, draw_selections)
+        tops = []
+        for ds in draw_selections:
+            dy = ds.height(width)
+            tops.append((ds, pos))
+            pos -= max(maxheight,dy)
+        return tops, pos
+    def bubbles(self, x, y, width, draw_selections=None):
+        "{selection @id: (left, bottom, width, height), ...} for contest drawn at x,y"
+        if draw_selections is None:
+            draw_selections = self.draw_selections
+        tops, _ = self._selectionTops(self._selectionsTop(y, width), width, draw_selections)
+        return {ds.atid:ds.bubbleCoords(x+1, dtop) for ds, dtop in tops}
     def _maxheight(self, width, draw_selections=None):
         "max height of the normal candidates. write-in is different"
         if draw_selections is None:
@@ -551,8 +733,7 @@ class CandidateContest:
         for ds in draw_selections:
             out += max(mh, ds.height(width))
         out += 4 # top and bottom border
-        tpar = Paragraph(self.BallotTitle, contestTitleStyle)
-        _, wh = tpar.wrap(width, 100)
+        _, wh = measureCache.size(self.BallotTitle, contestTitleStyle, width)
         out += wh + gs.subtitleLeading
         out += 0.1 * inch # header-choice gap
         out += 0.1 * inch # bottom padding
@@ -592,6 +773,8 @@ class RetentionContest:
         self.ElectionDistrictId = co['ElectionDistrictId'] # reference to a ReportingUnit gpunit
         setOptionalFields(self, self.co)
         self.draw_selections = [erctx.makeDrawOb(x) for x in self.ContestSelection]
+        # {selection @id: json ob} for OrderedContestSelectionIds
+        self.selectionsById = {x['@id']:x for x in self.ContestSelection}
         self._title = self.BallotTitle
         if not self._title:
             if self.OfficeIds:
@@ -607,8 +790,7 @@ class RetentionContest:
             draw_selections = self.draw_selections
         pos = y - 3 # leave room for 3pt top border
         # title
-        tpar = Paragraph(self._title, contestTitleStyle)
-        ww, wh = tpar.wrap(width, 100)
+        tpar, ww, wh = measureCache.paragraph(self._title, contestTitleStyle, width)
         c.setStrokeColorRGB(*gs.titleBGColor)
         c.setFillColorRGB(*gs.titleBGColor)
         c.rect(x, pos - wh, width, wh, fill=1, stroke=0)
@@ -622,7 +804,7 @@ class RetentionContest:
         c.setStrokeColorRGB(0,0,0)
         # TODO: skip BallotSubTitle if null/empty
         txto = c.beginText(x + 1 + (0.1 * inch), pos - gs.subtitleFontSize)
-        txto.setFont(gs.subtitleFontName, gs.subtitleFontSize)
+        txto.setFont(_font(gs.subtitleFontName), gs.subtitleFontSize)
         txto.textLines(self.BallotSubTitle or '')
         c.drawText(txto)
         pos -= gs.subtitleLeading
@@ -631,8 +813,7 @@ class RetentionContest:
 
         # SummaryText: e.g. 'Keep {candidate.ame} as {office.name} of the {gpu.name}'
         if self.SummaryText:
-            spar = Paragraph(self.SummaryText, contestSubtitleStyle)
-            ww, wh = spar.wrap(width, 100)
+            spar, ww, wh = measureCache.paragraph(self.SummaryText, contestSubtitleStyle, width)
             c.setStrokeColorRGB(*gs.titleBGColor)
             c.setFillColorRGB(1,1,1)
             c.rect(x, pos - wh, width, wh, fill=1, stroke=0)
@@ -640,11 +821,9 @@ class RetentionContest:
             pos -= wh
 
         pos -= 0.1 * inch # header-choice gap
-        maxheight = self._maxheight(width-1)
-        for ds in draw_selections:
-            dy = ds.height(width)
-            ds.draw(c, x+1, pos, width-1)
-            pos -= maxheight
+        tops, pos = self._selectionTops(pos, width, draw_selections)
+        for ds, dtop in tops:
+            ds.draw(c, x+1, dtop, width-1)
         pos -= 0.1 * inch # bottom padding
 
         # top border
@@ -659,6 +838,31 @@ class RetentionContest:
         path.lineTo(x+width, pos-0.5)
         c.drawPath(path, stroke=1)
         return
+    def _selectionsTop(self, y, width):
+        "below top border, title, subtitle, summary and gap; where the first selection goes"
+        pos = y - 3
+        _, wh = measureCache.size(self._title, contestTitleStyle, width)
+        pos -= wh
+        pos -= gs.subtitleLeading
+        if self.SummaryText:
+            _, wh = measureCache.size(self.SummaryText, contestSubtitleStyle, width)
+            pos -= wh
+        pos -= 0.1 * inch # header-choice gap
+        return pos
+    def _selectionTops(self, pos, width, draw_selections):
+        "return [(selection, top y), ...], bottom y"
+        maxheight = self._maxheight(width-1)
+        tops = []
+        for ds in draw_selections:
+            tops.append((ds, pos))
+            pos -= maxheight
+        return tops, pos
+    def bubbles(self, x, y, width, draw_selections=None):
+        "{selection @id: (left, bottom, width, height), ...} for contest drawn at x,y"
+        if draw_selections is None:
+            draw_selections = self.draw_selections
+        tops, _ = self._selectionTops(self._selectionsTop(y, width), width, draw_selections)
+        return {ds.atid:ds.bubbleCoords(x+1, dtop) for ds, dtop in tops}
     def _maxheight(self, width, draw_selections=None):
         draw_selections = draw_selections or self.draw_selections
         mh = None
@@ -673,18 +877,63 @@ class RetentionContest:
         draw_selections = draw_selections or self.draw_selections
         out = self._maxheight(width-1) * len(draw_selections)
         out += 4 # top and bottom border
-        tpar = Paragraph(self._title, contestSubtitleStyle)
-        _, wh = tpar.wrap(width, 100)
+        _, wh = measureCache.size(self._title, contestSubtitleStyle, width)
         out += wh
         out += gs.subtitleLeading
-        spar = Paragraph(self.SummaryText, selsubStyle)
-        _, wh = spar.wrap(width, 100)
+        _, wh = measureCache.size(self.SummaryText, selsubStyle, width)
         out += wh
         out += 0.1 * inch # header-choice gap
         out += 0.1 * inch # bottom padding
         return out
 
 
+def canvasForms(c):
+    "{key: form name} of form XObjects already in this canvas's document"
+    forms = getattr(c, '_ballotstudioForms', None)
+    if forms is None:
+        forms = {}
+        c._ballotstudioForms = forms
+    return forms
+
+# {file name in resources/: (ImageReader, (width, height)), ...}
+_images = {}
+_images_lock = threading.Lock()
+
+def resourceImage(fname):
+    "decoded image from resources/ and its (width, height), loaded once per process"
+    with _images_lock:
+        ent = _images.get(fname)
+        if ent is None:
+            im = ImageReader(os.path.join(resources, fname))
+            # decode now so later draws from other threads only read it
+            im.getRGBData()
+            ent = (im, im.getSize())
+            _images[fname] = ent
+    return ent
+
+def resourceImageSize(fname):
+    return resourceImage(fname)[1]
+
+def drawResourceImage(c, fname, x, y, width, height):
+    "draw image from resources/, embedded once per document as a form XObject and placed from there"
+    forms = canvasForms(c)
+    key = ('image', fname)
+    name = forms.get(key)
+    if name is None:
+        name = 'bsform{}'.format(len(forms))
+        im, _ = resourceImage(fname)
+        # unit square, scaled into place by doForm() callers
+        c.beginForm(name, lowerx=0, lowery=0, upperx=1, uppery=1)
+        c.drawImage(im, 0, 0, 1, 1)
+        c.endForm()
+        forms[key] = name
+    c.saveState()
+    c.translate(x, y)
+    c.scale(width, height)
+    c.doForm(name)
+    c.restoreState()
+
+
 class InstructionsHeader:
     header1 = 'Making selections'
     image1 = 'filled bubble.png'
@@ -725,7 +974,7 @@ class InstructionsHeader:
             c.setFillColorRGB(0,0,0)
             c.setStrokeColorRGB(0,0,0)
             txto = c.beginText(x + 1 + (0.1 * inch), pos - gs.titleFontSize)
-            txto.setFont(gs.titleFontName, gs.titleFontSize)
+            txto.setFont(_font(gs.titleFontName), gs.titleFontSize)
             txto.textLines('Instructions')
             c.drawText(txto)
         pos -= gs.titleLeading
@@ -734,37 +983,38 @@ class InstructionsHeader:
         textx = x + 1 + (0.1 * inch)
         availableWidth = width - (1 + (0.1 * inch))
 
-        bubbleImage = ImageReader(os.path.join(resources, self.image1))
-        imw, imh = bubbleImage.getSize()
+        imw, imh = resourceImageSize(self.image1)
         imHeight = imh * (availableWidth / imw)
         if enable:
-            c.drawImage(bubbleImage, textx, pos - imHeight, availableWidth, imHeight)
+            drawResourceImage(c, self.image1, textx, pos - imHeight, availableWidth, imHeight)
         pos -= imHeight
 
-        i1par = Paragraph(self.instruction1, instructionStyle)
-        ww, wh = i1par.wrap(availableWidth, 100)
         if enable:
+            i1par, ww, wh = measureCache.paragraph(self.instruction1, instructionStyle, availableWidth)
             i1par.drawOn(c, textx, pos-wh)
+        else:
+            ww, wh = measureCache.size(self.instruction1, instructionStyle, availableWidth)
         pos -= wh
         # TODO: warning style
-        i1par = Paragraph(self.warning1, instructionStyle)
-        ww, wh = i1par.wrap(availableWidth, 100)
         if enable:
+            i1par, ww, wh = measureCache.paragraph(self.warning1, instructionStyle, availableWidth)
             i1par.drawOn(c, textx, pos-wh)
+        else:
+            ww, wh = measureCache.size(self.warning1, instructionStyle, availableWidth)
         pos -= wh
         pos -= gs.candsubLeading
 
-        writeInIm = ImageReader(os.path.join(resources, self.image2))
-        imw, imh = writeInIm.getSize()
+        imw, imh = resourceImageSize(self.image2)
         imHeight = imh * (availableWidth / imw)
         if enable:
-            c.drawImage(writeInIm, textx, pos - imHeight, availableWidth, imHeight)
+            drawResourceImage(c, self.image2, textx, pos - imHeight, availableWidth, imHeight)
         pos -= imHeight
 
-        i1par = Paragraph(self.instruction2, instructionStyle)
-        ww, wh = i1par.wrap(availableWidth, 100)
         if enable:
+            i1par, ww, wh = measureCache.paragraph(self.instruction2, instructionStyle, availableWidth)
             i1par.drawOn(c, textx, pos-wh)
+        else:
+            ww, wh = measureCache.size(self.instruction2, instructionStyle, availableWidth)
         pos -= wh
 
         pos -= 0.1 * inch # bottom padding
@@ -816,6 +1066,7 @@ class OrderedContest:
     def __init__(self, erctx, contest_json_object):
         co = contest_json_object
         self.co = co
+        self.erctx = erctx
         self.contest = erctx.getDrawOb(co['ContestId'])
         self.atid = co['ContestId']
         # selection_ids refs by id to PartySelection, BallotMeasureSelection, CandidateSelection; TODO: dereference, where do they come from?
@@ -823,7 +1074,7 @@ class OrderedContest:
         selection_ids = co.get('OrderedContestSelectionIds', [])
         # because we might shuffle the candidate presentation order on different ballots:
         if selection_ids:
-            self.ordered_selections = [byId(raw_selections, x) for x in selection_ids]
+            self.ordered_selections = [self.contest.selectionsById[x] for x in selection_ids]
         else:
             self.ordered_selections = raw_selections
         self.draw_selections = [erctx.makeDrawOb(x) for x in self.ordered_selections]
@@ -832,10 +1083,28 @@ class OrderedContest:
     def height(self, width):
         return self.contest.height(width, draw_selections=self.draw_selections)
     def draw(self, c, x, y, width):
-        self.contest.draw(c, x, y, width, draw_selections=self.draw_selections)
+        # The same contest block shows up on many ballot styles.
+        # Draw it once per document as a form XObject and place that.
+        marked = tuple([ds.atid for ds in self.draw_selections if self.erctx.isMarked(ds.atid)])
+        key = ('contest', self.atid, tuple([ds.atid for ds in self.draw_selections]), width, marked)
+        forms = canvasForms(c)
+        name = forms.get(key)
+        if name is None:
+            name = 'bsform{}'.format(len(forms))
+            # Form BBox clips. Allow anything that would have landed on the page,
+            # height() can be an underestimate and long subtitles overflow the column.
+            pagewidth, pageheight = c._pagesize
+            c.beginForm(name, lowerx=-pagewidth, lowery=-pageheight, upperx=pagewidth, uppery=pageheight)
+            self.contest.draw(c, 0, 0, width, draw_selections=self.draw_selections)
+            c.endForm()
+            forms[key] = name
+        c.saveState()
+        c.translate(x, y)
+        c.doForm(name)
+        c.restoreState()
         return
-    def getBubbles(self):
-        return {ch.atid:ch._bubbleCoords for ch in self.draw_selections}
+    def bubbles(self, x, y, width):
+        return self.contest.bubbles(x, y, width, draw_selections=self.draw_selections)
 
 class OrderedHeader:
     def __init__(self, erctx, contest_json_object):
@@ -851,10 +1120,102 @@ class OrderedHeader:
     def draw(self, c, x, y, width):
         self.header.draw(c, x, y, width)
         return
-    def getBubbles(self):
+    def bubbles(self, x, y, width):
         return None
 
 
+class BallotStyleLayout:
+    """Pages, columns and placed content for one BallotStyle, computed without drawing.
+
+    items are dicts:
+    {"index": index into BallotStyle.content, "atid": contest or header @id,
+     "page": int, "column": int, "box": [left, top, right, bottom],
+     "bubbles": {selection @id: [left, bottom, width, height], ...} or None}
+    """
+    def __init__(self, pagesize, columns=3):
+        widthpt, heightpt = pagesize
+        self.pagesize = tuple(pagesize)
+        self.contenttop = heightpt - gs.pageMargin
+        self.contentbottom = gs.pageMargin
+        self.contentleft = gs.pageMargin
+        self.contentright = widthpt - gs.pageMargin
+        # (columnwidth * columns) + (gs.columnMargin * (columns - 1)) == width
+        self.columns = columns
+        self.columnwidth = (self.contentright - self.contentleft - (gs.columnMargin * (columns - 1))) / columns
+        self.numPages = 0
+        # {page number: (left, top, right, bottom), ...}
+        self.headerBoxes = {}
+        self.items = []
+    def place(self, xc, index, page, column, x, y, height):
+        self.items.append({
+            'index': index,
+            'atid': xc.atid,
+            'page': page,
+            'column': column,
+            'box': (x, y, x + self.columnwidth, y - height),
+            'bubbles': xc.bubbles(x, y, self.columnwidth),
+        })
+    def pages(self):
+        "[[item, ...] for page 1, ...]"
+        out = [[] for _ in range(self.numPages)]
+        for item in self.items:
+            out[item['page']-1].append(item)
+        return out
+    def getBubbles(self):
+        "{contest @id: {selection @id: [left, bottom, width, height], ...}, ...}"
+        return {item['atid']:item['bubbles'] for item in self.items if item['bubbles']}
+    def getHeaderBoxes(self):
+        return self.headerBoxes
+    def toJson(self):
+        return {
+            'pagesize': list(self.pagesize),
+            'columns': self.columns,
+            'columnwidth': self.columnwidth,
+            'contenttop': self.contenttop,
+            'contentbottom': self.contentbottom,
+            'contentleft': self.contentleft,
+            'contentright': self.contentright,
+            'numPages': self.numPages,
+            'headers': {str(page):list(box) for page, box in self.headerBoxes.items()},
+            'items': [dict(item, box=list(item['box'])) for item in self.items],
+        }
+    @classmethod
+    def fromJson(cls, ob):
+        lo = cls(ob['pagesize'], ob['columns'])
+        lo.columnwidth = ob['columnwidth']
+        lo.contenttop = ob['contenttop']
+        lo.contentbottom = ob['contentbottom']
+        lo.contentleft = ob['contentleft']
+        lo.contentright = ob['contentright']
+        lo.numPages = ob['numPages']
+        lo.headerBoxes = {int(page):tuple(box) for page, box in ob['headers'].items()}
+        lo.items = [dict(item, box=tuple(item['box'])) for item in ob['items']]
+        return lo
+
+
+class LayoutPlan:
+    """Layout for every BallotStyle of an Election.
+    PDF drawing and bubble export are both driven from this.
+    Entries in styles are None until that BallotStyle has been laid out.
+    JSON serializable with toJson()/fromJson() so it can be cached apart from PDF bytes.
+    """
+    def __init__(self, pagesize, numStyles):
+        self.pagesize = tuple(pagesize)
+        self.styles = [None] * numStyles
+    def complete(self):
+        return all(self.styles)
+    def toJson(self):
+        return {
+            'pagesize': list(self.pagesize),
+            'styles': [lo and lo.toJson() for lo in self.styles],
+        }
+    @classmethod
+    def fromJson(cls, ob):
+        plan = cls(ob['pagesize'], len(ob['styles']))
+        plan.styles = [lo and BallotStyleLayout.fromJson(lo) for lo in ob['styles']]
+        return plan
+
+
 def dateForHumans(anydate):
     "try to parse YYYY-MM-DD, return long human date"
     try:
@@ -864,6 +1225,12 @@ def dateForHumans(anydate):
     except:
         return anydate
 
+# reference fields followed by BallotStyle.fingerprint(), the ones that change what gets drawn
+_drawRefKeys = frozenset([
+    'CandidateId', 'CandidateIds', 'ContestId', 'EndorsementPartyIds', 'GpUnitIds',
+    'HeaderId', 'OfficeIds', 'PartyId', 'PartyIds', 'PersonId',
+])
+
 class BallotStyle:
     def __init__(self, erctx, ballotstyle_json_object):
         try:
@@ -877,20 +1244,17 @@ class BallotStyle:
             self.content = [erctx.makeDrawOb(ob) for ob in bs.get('OrderedContent', [])]
             # e.g. for a party-specific primary ballot (may associate with multiple parties)
             self.parties = [erctx.getRawOb(x) for x in bs.get('PartyIds', [])]
-            # _numPages gets filled in on a first rendering pass and used on second pass
+            # _numPages gets filled in by the layout() pagination pass and used when drawing
             self._numPages = 'X'
             self._pageHeader = bs.get('PageHeader') # extension field
-            self._bubbles = None
-            self._headerBoxes = {}
-            self.contenttop = None
-            self.contentbottom = None
-            self.contentleft = None
-            self.contentright = None
         except Exception as e:
             logger.error('error processing BallotStyle js, %s, %s', e, json.dumps(bs))
             raise
     def select(self, selectors):
+        "match by GpUnit @id, ExternalIdentifier or ImageUri"
         for sel in selectors:
+            if sel in self.bs['GpUnitIds']:
+                return True
             if sel in self.ext:
                 return True
             if sel in self.image_uri:
@@ -922,129 +1286,219 @@ class BallotStyle:
             PLACES=gpunitnames,
             PLACE=place,
         )
+    def fingerprint(self):
+        """sha256 hex of everything drawing this BallotStyle depends on.
+        The ballot style json, the objects it refers to (contests, selections, candidates, people, parties,
+        offices, headers, gpunits), election dates, draw Settings and RENDER_VERSION. Same fingerprint, same layout and PDF."""
+        erctx = self.erctx
+        refs = {}
+        stack = [self.bs]
+        while stack:
+            x = stack.pop()
+            if isinstance(x, dict):
+                for k, v in x.items():
+                    if k in _drawRefKeys:
+                        for rid in (v if isinstance(v, list) else [v]):
+                            if (rid not in refs) and (rid in erctx.obids):
+                                refs[rid] = erctx.obids[rid]
+                                stack.append(refs[rid])
+                    else:
+                        stack.append(v)
+            elif isinstance(x, (list,tuple)):
+                stack.extend(x)
+        ep = erctx.eprinter
+        ob = {
+            'bs': self.bs,
+            'refs': refs,
+            'election': [ep.name, ep.startdate, ep.enddate, ep.election_type, ep.election_type_other],
+            'settings': gs.__dict__,
+            'version': RENDER_VERSION,
+        }
+        blob = json.dumps(ob, sort_keys=True, separators=(',',':'), default=repr)
+        return hashlib.sha256(blob.encode()).hexdigest()
     def pageHeaderTemplate(self):
         if self._pageHeader is not None:
             return self._pageHeader
         return '''General Election, {DATE}
 {PLACES} page {PAGE} of {PAGES}'''
-    def drawPageHeader(self, c, page):
+    def _layoutPageHeader(self, lo, page):
+        "record page header box in layout, return content top below it"
+        top = lo.contenttop
+        nlines = len(self.pageHeaderText(page).splitlines())
+        pageHeaderHeight = gs.headerLeading * nlines + 0.1*inch
+        box = (lo.contentleft + 0.1*inch, top,
+               lo.contentright, top - pageHeaderHeight)
+        logger.debug('bs (%r) page %s box %r', self.bs['GpUnitIds'], page, box)
+        lo.headerBoxes[page] = box
+        return top - pageHeaderHeight
+    def drawPageHeader(self, c, lo, page):
+        _, top, _, bottom = lo.headerBoxes[page]
+        pageHeaderHeight = top - bottom
         c.setStrokeColorRGB(0,0,0)
         c.setLineWidth(1.0)
-        c.line(self.contentleft, self.contenttop, self.contentright, self.contenttop)
+        c.line(lo.contentleft, top, lo.contentright, top)
         headerText = self.pageHeaderText(page)
-        txto = c.beginText(self.contentleft + 0.1*inch, self.contenttop - gs.headerFontSize)
-        txto.setFont(gs.headerFontName, gs.headerFontSize, gs.headerLeading)
-        nlines = len(headerText.splitlines())
+        txto = c.beginText(lo.contentleft + 0.1*inch, top - gs.headerFontSize)
+        txto.setFont(_font(gs.headerFontName), gs.headerFontSize, gs.headerLeading)
         txto.textLines(headerText)
         c.drawText(txto)
-        pageHeaderHeight = gs.headerLeading * nlines + 0.1*inch
         pntext = '{PAGE}<font size="{smsize}">/{PAGES}</font>'.format(PAGE=page, PAGES=self._numPages, smsize=gs.headerFontSize)
-        pnpar = Paragraph(pntext, pageHeaderNumberStyle)
-        ww, wh = pnpar.wrap(inch,pageHeaderHeight)
-        pnpar.drawOn(c, self.contentright - ww, self.contenttop - wh)
-        box = (self.contentleft + 0.1*inch, self.contenttop,
-               self.contentright, self.contenttop - pageHeaderHeight)
-        logger.debug('bs (%r) page %s box %r', self.bs['GpUnitIds'], page, box)
-        self._headerBoxes[page] = box
-        self.contenttop -= pageHeaderHeight
+        pnpar, ww, wh = measureCache.paragraph(pntext, pageHeaderNumberStyle, inch)
+        pnpar.drawOn(c, lo.contentright - ww, top - wh)
 
     def name(self):
         return ','.join([gpunitName(gpu) for gpu in self.gpunits])
-    def draw(self, c, pagesize):
-        widthpt, heightpt = pagesize
-        self.contenttop = heightpt - gs.pageMargin
-        self.contentbottom = gs.pageMargin
-        self.contentleft = gs.pageMargin
-        self.contentright = widthpt - gs.pageMargin
-        y = self.contenttop
-        x = self.contentleft
+    def layout(self, pagesize):
+        """Pagination pass.
+        Measure content and assign it to columns and pages without drawing anything.
+        Returns BallotStyleLayout and sets _numPages for page headers."""
+        lo = BallotStyleLayout(pagesize)
+        contentbottom = lo.contentbottom
+        if gs.nowstrEnabled:
+            # room for the 'generated' date string on the first page
+            contentbottom += (gs.nowstrFontSize * 1.2)
         page = 1
+        coltop = self._layoutPageHeader(lo, page)
+        y = coltop
+        x = lo.contentleft
+        colnum = 1
+        for i, xc in enumerate(self.content):
+            height = xc.height(lo.columnwidth)
+            if y - height < contentbottom:
+                # start a new column
+                y = coltop
+                colnum += 1
+                if (colnum > lo.columns) or (height == _PAGE_BREAK_HEIGHT):
+                    # start a new page
+                    page += 1
+                    colnum = 1
+                    # only the first page has the debug string
+                    contentbottom = lo.contentbottom
+                    coltop = self._layoutPageHeader(lo, page)
+                    x = lo.contentleft
+                    y = coltop
+                else:
+                    x += lo.columnwidth + gs.columnMargin
+            if (height == _COLUMN_BREAK_HEIGHT) or (height == _PAGE_BREAK_HEIGHT):
+                # no actual content
+                continue
+            # TODO: wrap super long issues
+            lo.place(xc, i, page, colnum, x, y, height)
+            y -= height
+            y += 1 # bottom border and top border may overlap
+        lo.numPages = page
+        self._numPages = page
+        return lo
+    def draw(self, c, pagesize, layout=None):
+        "draw from layout, running the pagination pass first if needed"
+        lo = layout
+        if (lo is None) or (tuple(lo.pagesize) != tuple(pagesize)):
+            lo = self.layout(pagesize)
+        self._numPages = lo.numPages
+        widthpt, heightpt = pagesize
         if gs.debugPageOutline:
             # draw page outline debug, a red border at content limit
             c.setLineWidth(0.2)
             c.setFillColorRGB(1,1,1)
             c.setStrokeColorRGB(1,.6,.6)
-            c.rect(self.contentleft, self.contentbottom, widthpt - (2 * gs.pageMargin), heightpt - (2 * gs.pageMargin), stroke=1, fill=0)
+            c.rect(lo.contentleft, lo.contentbottom, widthpt - (2 * gs.pageMargin), heightpt - (2 * gs.pageMargin), stroke=1, fill=0)
             c.setLineWidth(1)
         nowstr = 'generated ' + time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime())
         c.setTitle('ballot test ' + nowstr)
         if gs.nowstrEnabled:
             c.setFillColorRGB(0,0,0)
             c.setStrokeColorRGB(0,0,0)
-            dtw = pdfmetrics.stringWidth(nowstr, gs.nowstrFontName, gs.nowstrFontSize)
+            dtw = pdfmetrics.stringWidth(nowstr, _font(gs.nowstrFontName), gs.nowstrFontSize)
             c.setFont(gs.nowstrFontName, gs.nowstrFontSize)
-            c.drawString(self.contentright - dtw, self.contentbottom + (gs.nowstrFontSize * 0.2), nowstr)
-            self.contentbottom += (gs.nowstrFontSize * 1.2)
+            c.drawString(lo.contentright - dtw, lo.contentbottom + (gs.nowstrFontSize * 0.2), nowstr)
 
-        self.drawPageHeader(c, page)
+        page = 1
+        self.drawPageHeader(c, lo, page)
         # TODO: instruction box
-        y = self.contenttop
-
-        # (columnwidth * columns) + (gs.columnMargin * (columns - 1)) == width
-        columns = 3
-        columnwidth = (self.contentright - self.contentleft - (gs.columnMargin * (columns - 1))) / columns
-        bubbles = {}
-        # content, 2 columns
-        colnum = 1
-        for xc in self.content:
-            height = xc.height(columnwidth)
-            if y - height < self.contentbottom:
-                # start a new column
-                y = self.contenttop
-                colnum += 1
-                if (colnum > columns) or (height == _PAGE_BREAK_HEIGHT):
-                    # start a new page
-                    c.showPage()
-                    page += 1
-                    colnum = 1
-                    # reset contenttop for prior header
-                    self.contenttop = heightpt - gs.pageMargin
-                    # reset contentbottom in case of debug string
-                    self.contentbottom = gs.pageMargin
-                    self.drawPageHeader(c, page)
-                    x = self.contentleft
-                    y = self.contenttop
-                else:
-                    x += columnwidth + gs.columnMargin
-            if (height == _COLUMN_BREAK_HEIGHT) or (height == _PAGE_BREAK_HEIGHT):
-                # no actual content
-                continue
-            # TODO: wrap super long issues
-            xc.draw(c, x, y, columnwidth)
-            y -= height
-            y += 1 # bottom border and top border may overlap
-            xb = xc.getBubbles()
-            if xb:
-                #logger.info('xc %r %s bubbles %r', xc, xc.atid, xb)
-                #bubbles.append(xb)
-                bubbles[xc.atid] = xb
+        for item in lo.items:
+            while page < item['page']:
+                c.showPage()
+                page += 1
+                self.drawPageHeader(c, lo, page)
+            xc = self.content[item['index']]
+            left, top, _, _ = item['box']
+            xc.draw(c, left, top, lo.columnwidth)
+        while page < lo.numPages:
+            # trailing break with nothing after it
+            c.showPage()
+            page += 1
+            self.drawPageHeader(c, lo, page)
         c.showPage()
-        self._numPages = page
-        self._bubbles = bubbles
-    def getBubbles(self):
-        return self._bubbles
-    def getHeaderBoxes(self):
-        return self._headerBoxes
 
 
 
+# ElectionReport fields that don't change what gets drawn
+_undrawnReportKeys = ('GeneratedDate',)
+
+def electionFingerprint(er):
+    "sha256 hex of canonical ElectionReport json, draw Settings and RENDER_VERSION, content address of its rendering"
+    er = {k:v for k,v in er.items() if k not in _undrawnReportKeys}
+    blob = json.dumps({'er': er, 'settings': gs.__dict__, 'version': RENDER_VERSION}, sort_keys=True, separators=(',',':'), default=repr)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def walkTyped(ob):
+    "yield every dict with @type and @id within ob, depth first, without recursion"
+    stack = [ob]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, dict):
+            if (x.get('@type') is not None) and (x.get('@id') is not None):
+                yield x
+            stack.extend(reversed(list(x.values())))
+        elif isinstance(x, (list,tuple)):
+            stack.extend(reversed(x))
+
 def gatherIds(ob):
-    out = dict()
-    _gatherIds(out, ob)
-    return out
-def _gatherIds(out, ob):
-    if isinstance(ob, dict):
-        dtype = ob.get('@type')
-        did = ob.get('@id')
-        if dtype is not None and did is not None:
-            if did in out:
-                raise Exception('@id collision {!r} for {!r} and {!r}'.format(did, out[did], ob))
-            out[did] = ob
-        for k, v in ob.items():
-            _gatherIds(out, v)
-    elif isinstance(ob, (list,tuple)):
-        for x in ob:
-            _gatherIds(out, x)
+    return ObjectIndex(ob).obids
+
+class ObjectIndex:
+    """{@id: json ob} for every typed object in an ElectionReport.
+    Build once per report and share between every ElectionPrinter for it.
+    Edits can be applied with add(), remove() and replace() instead of a full rescan.
+    """
+    def __init__(self, er=None):
+        self.obids = {}
+        # seconds spent indexing, total
+        self.elapsed = 0.0
+        if er is not None:
+            self.add(er)
+    def add(self, ob):
+        "index ob and everything within it"
+        start = time.perf_counter()
+        count = 0
+        obids = self.obids
+        for x in walkTyped(ob):
+            did = x['@id']
+            if did in obids:
+                raise Exception('@id collision {!r} for {!r} and {!r}'.format(did, obids[did], x))
+            obids[did] = x
+            count += 1
+        dt = time.perf_counter() - start
+        self.elapsed += dt
+        logger.debug('indexed %d objects in %.4fs', count, dt)
+    def remove(self, ob):
+        "drop ob and everything within it from the index"
+        start = time.perf_counter()
+        for x in walkTyped(ob):
+            self.obids.pop(x['@id'], None)
+        self.elapsed += time.perf_counter() - start
+    def replace(self, old, new):
+        "re-index an edited part of the report, old and new may be whole objects or lists of them"
+        self.remove(old)
+        self.add(new)
+    def get(self, id_string, default=None):
+        return self.obids.get(id_string, default)
+    def __getitem__(self, id_string):
+        return self.obids[id_string]
+    def __contains__(self, id_string):
+        return id_string in self.obids
+    def __len__(self):
+        return len(self.obids)
 
 CandidateType = 'ElectionResults.Candidate'
 CandidateContestType = 'ElectionResults.CandidateContest'
@@ -1070,11 +1524,15 @@ class ElectionResultsContext:
         'ElectionResults.Header': Header,
         #'ElectionResults.Office': Office,
     }
-    def __init__(self, election_results_json_object, eprinter):
+    def __init__(self, election_results_json_object, eprinter, index=None):
         self.er = election_results_json_object
         self.eprinter = eprinter # ElectionPrinter{}
+        # ObjectIndex may be shared with other ElectionPrinter for the same report
+        if index is None:
+            index = ObjectIndex(self.er)
+        self.index = index
         # obids = {@id: json ob, ...}
-        self.obids = gatherIds(self.er)
+        self.obids = index.obids
         # draw objects by id, same key as obids
         self.dobs = {}
         # contestMarkedCsels is the same two level map returned by ballot scanner
@@ -1082,6 +1540,8 @@ class ElectionResultsContext:
         # For this purpose it can also be cheated skipping the contest part:
         # {"x":{cselId:True, ...}}
         self.contestMarkedCsels = None
+        # flat set of every marked csel @id, built once by setMarks()
+        self.markedCsels = frozenset()
     def getRawOb(self, id_string):
         return self.obids[id_string]
     def getDrawOb(self, id_string):
@@ -1103,14 +1563,15 @@ class ElectionResultsContext:
         if atid:
             self.dobs[atid] = dob
         return dob
+    def setMarks(self, contestMarkedCsels):
+        self.contestMarkedCsels = contestMarkedCsels
+        marked = set()
+        if contestMarkedCsels:
+            for mc in contestMarkedCsels.values():
+                marked.update(mc)
+        self.markedCsels = frozenset(marked)
     def isMarked(self, cselId):
-        if self.contestMarkedCsels is None:
-            return False
-        logger.debug('%r in? %r', cselId, self.contestMarkedCsels)
-        for mc in self.contestMarkedCsels.values():
-            if cselId in mc:
-                return True
-        return False
+        return cselId in self.markedCsels
 
 
 
@@ -1128,12 +1589,13 @@ _election_types_en = {
 }
 
 class ElectionPrinter:
-    def __init__(self, election_report, election):
+    def __init__(self, election_report, election, index=None):
         # election_report ElectionResults.ElectionReport from json
         # election ElectionResults.Election from json
+        # index optional ObjectIndex of election_report, to share between ElectionPrinter
         er = election_report
         el = election
-        erctx = ElectionResultsContext(er, self)
+        erctx = ElectionResultsContext(er, self, index)
         self.erctx = erctx
         self.er = er
         self.el = el
@@ -1150,61 +1612,137 @@ class ElectionPrinter:
         self.ballot_styles = []
         for bstyle in el.get('BallotStyle', []):
             self.ballot_styles.append(BallotStyle(erctx,bstyle))
+        self._plan = None
         return
     def setMarks(self, marks):
         "marks is map[contest @id]map[csel @id](bool marked)"
-        self.erctx.contestMarkedCsels = marks
+        self.erctx.setMarks(marks)
+    def layoutPlan(self, selectors=None):
+        "LayoutPlan with every BallotStyle (or those matching selectors) laid out. Computed once and kept."
+        _ensure_fonts()
+        plan = self._currentPlan()
+        for i, bs in enumerate(self.ballot_styles):
+            if (selectors is not None) and not bs.select(selectors):
+                continue
+            if plan.styles[i] is None:
+                plan.styles[i] = bs.layout(gs.pagesize)
+        return plan
+    def styleLayout(self, i):
+        "BallotStyleLayout for ballot_styles[i], laid out now if not already"
+        _ensure_fonts()
+        plan = self._currentPlan()
+        if plan.styles[i] is None:
+            plan.styles[i] = self.ballot_styles[i].layout(gs.pagesize)
+        return plan.styles[i]
+    def styleFingerprint(self, i):
+        return self.ballot_styles[i].fingerprint()
+    def _currentPlan(self):
+        plan = self._plan
+        if (plan is None) or (plan.pagesize != tuple(gs.pagesize)) or (len(plan.styles) != len(self.ballot_styles)):
+            plan = LayoutPlan(gs.pagesize, len(self.ballot_styles))
+            self._plan = plan
+        return plan
+    def setLayoutPlan(self, plan):
+        "use a previously computed (maybe deserialized) LayoutPlan for this election"
+        if len(plan.styles) != len(self.ballot_styles):
+            raise Exception('LayoutPlan has {} ballot styles, election has {}'.format(len(plan.styles), len(self.ballot_styles)))
+        self._plan = plan
     def electionTypeTitle(self):
         # TODO: i18n
         if self.election_type == 'other':
             return self.election_type_other
         return _election_types_en[self.election_type]
 
-    def drawToDir(self, outdir, outname_prefix=None, selectors=None):
-        outpaths = []
-        _ensure_fonts()
+    def drawToDir(self, outdir, outname_prefix=None, selectors=None, workers=None):
+        """Write a PDF per BallotStyle into outdir.
+        workers > 1 spreads ballot styles across a process pool."""
         if outname_prefix is None:
             outname_prefix = self.name + '_'
+        if workers and workers > 1:
+            return self._drawToDirPool(outdir, outname_prefix, selectors, workers)
+        outpaths = []
         for i, bs in enumerate(self.ballot_styles):
             if (selectors is not None) and not bs.select(selectors):
                 continue
-            names = ','.join([gpunitName(x) for x in bs.gpunits])
-            if len(self.ballot_styles) > 1:
-                bs_fname = '{}{}_{}.pdf'.format(outname_prefix, i, names)
-            else:
-                bs_fname = '{}{}.pdf'.format(outname_prefix, names)
-            if outdir:
-                bs_fname = os.path.join(outdir, bs_fname)
-            # dummy draw for pagination
-            outdummy = io.BytesIO()
-            dc = canvas.Canvas(outdummy, pagesize=gs.pagesize)
-            bs.draw(dc, gs.pagesize)
-            outdummy = None
-            dc = None
-            # real draw
+            bs_fname = self._styleFilename(outdir, outname_prefix, i)
             outpaths.append(bs_fname)
-            c = canvas.Canvas(bs_fname, pagesize=gs.pagesize) # pageCompression=1
-            bs.draw(c, gs.pagesize)
-            c.save()
+            self.drawStyle(i, bs_fname)
+        logger.debug('measureCache %r', measureCache.stats())
         return outpaths
 
-    def drawToFile(self, outfile=None, selectors=None):
+    def _styleFilename(self, outdir, outname_prefix, i):
+        bs = self.ballot_styles[i]
+        names = ','.join([gpunitName(x) for x in bs.gpunits])
+        if len(self.ballot_styles) > 1:
+            bs_fname = '{}{}_{}.pdf'.format(outname_prefix, i, names)
+        else:
+            bs_fname = '{}{}.pdf'.format(outname_prefix, names)
+        if outdir:
+            bs_fname = os.path.join(outdir, bs_fname)
+        return bs_fname
+
+    def _drawToDirPool(self, outdir, outname_prefix, selectors, workers):
+        indexes = []
+        outpaths = []
+        for i, bs in enumerate(self.ballot_styles):
+            if (selectors is not None) and not bs.select(selectors):
+                continue
+            indexes.append(i)
+            outpaths.append(self._styleFilename(outdir, outname_prefix, i))
+        plan = self._currentPlan()
+        # spawn and forkserver workers re-import this module, carry over any changes to gs
+        initargs = (self.er, self.el, self.erctx.contestMarkedCsels, dict(gs.__dict__))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_drawWorkerInit, initargs=initargs) as pool:
+            # map() hands results back in submission order
+            for i, bs_fname, lojs in zip(indexes, outpaths, pool.map(_drawWorkerStyle, indexes, outpaths)):
+                plan.styles[i] = BallotStyleLayout.fromJson(lojs)
+                logger.debug('wrote %s', bs_fname)
+        return outpaths
+
+    def drawStyle(self, i, outfile=None):
+        "draw just ballot_styles[i] into its own PDF"
+        lo = self.styleLayout(i)
+        c = canvas.Canvas(outfile, pagesize=gs.pagesize) # pageCompression=1
+        self.ballot_styles[i].draw(c, gs.pagesize, lo)
+        c.save()
+
+    def drawToFile(self, outfile=None, selectors=None, progress=None):
         # TODO: one specific ballot style or all of them to separate PDFs
+        # progress(done, total) if given is called as each ballot style is drawn
         _ensure_fonts()
         any = False
+        plan = self.layoutPlan(selectors)
         c = canvas.Canvas(outfile, pagesize=gs.pagesize) # pageCompression=1
-        for i, bs in enumerate(self.ballot_styles):
-            if (selectors is not None) and not bs.select(selectors):
-                continue
+        todo = [i for i, bs in enumerate(self.ballot_styles) if (selectors is None) or bs.select(selectors)]
+        for done, i in enumerate(todo):
             any = True
-            # dummy draw for pagination
-            outdummy = io.BytesIO()
-            dc = canvas.Canvas(outdummy, pagesize=gs.pagesize)
-            bs.draw(dc, gs.pagesize)
-            outdummy = None
-            dc = None
-            # real draw
-            bs.draw(c, gs.pagesize)
+            self.ballot_styles[i].draw(c, gs.pagesize, plan.styles[i])
+            if progress is not None:
+                progress(done+1, len(todo))
+        logger.debug('measureCache %r', measureCache.stats())
+        if any:
+            c.save()
+        else:
+            raise Exception('No BallotStyles drawn for selectors {!r}'.format(selectors))
+    def drawMarkSets(self, marksets, outfile=None, selectors=None):
+        """Draw every ballot style (or those matching selectors) once per set of marks, all into one PDF.
+        e.g. a test deck. Layout is computed once and reused for every set of marks,
+        contest blocks with the same marks reuse the same form XObject."""
+        _ensure_fonts()
+        plan = self.layoutPlan(selectors)
+        prevMarks = self.erctx.contestMarkedCsels
+        c = canvas.Canvas(outfile, pagesize=gs.pagesize) # pageCompression=1
+        any = False
+        try:
+            for marks in marksets:
+                self.setMarks(marks)
+                for i, bs in enumerate(self.ballot_styles):
+                    if (selectors is not None) and not bs.select(selectors):
+                        continue
+                    any = True
+                    bs.draw(c, gs.pagesize, plan.styles[i])
+        finally:
+            self.setMarks(prevMarks)
         if any:
             c.save()
         else:
@@ -1236,10 +1774,12 @@ class ElectionPrinter:
         # bubbles["bsdata"][ballotStyleIndex]["bubbles"][contest id str][selection id str] = [left, bottom, width, height]
         # bubbles["bsdata"][ballotStyleIndex]["headers"][page number str] = [left, top, right, bottom]
         # TODO: fix docstring above to reflect data below
+        # Geometry only: this needs the LayoutPlan but no canvas, nothing gets drawn.
+        plan = self.layoutPlan()
         bsdata = []
         oneheader = None
-        for bs in self.ballot_styles:
-            headers = bs.getHeaderBoxes()
+        for bs, lo in zip(self.ballot_styles, plan.styles):
+            headers = lo.getHeaderBoxes()
             for hb in headers.values():
                 if oneheader is None:
                     oneheader = hb
@@ -1249,7 +1789,7 @@ class ElectionPrinter:
                         raise Exception('header box {!r} != {!r}'.format(oneheader, hb))
             ob = {
                 'GpUnitIds': bs.bs['GpUnitIds'],
-                'bubbles': bs.getBubbles(),
+                'bubbles': lo.getBubbles(),
                 'headers': headers,
             }
             bsdata.append(ob)
@@ -1258,10 +1798,25 @@ class ElectionPrinter:
             # bsdata is the way
             'bsdata': bsdata,
             # TODO: deprecate top level 'bubbles' and 'headers'
-            'bubbles': [bs.getBubbles() for bs in self.ballot_styles],
-            'headers': [bs.getHeaderBoxes() for bs in self.ballot_styles],
+            'bubbles': [lo.getBubbles() for lo in plan.styles],
+            'headers': [lo.getHeaderBoxes() for lo in plan.styles],
         }
 
+# process pool worker state for ElectionPrinter.drawToDir(workers=N)
+_worker_ep = None
+
+def _drawWorkerInit(er, el, marks, settings):
+    global _worker_ep
+    gs.__dict__.update(settings)
+    _ensure_fonts()
+    _worker_ep = ElectionPrinter(er, el)
+    _worker_ep.setMarks(marks)
+
+def _drawWorkerStyle(i, bs_fname):
+    "draw one BallotStyle to its own file, return its layout json"
+    _worker_ep.drawStyle(i, bs_fname)
+    return _worker_ep.styleLayout(i).toJson()
+
 # for a list of NIST-1500-100 v2 json/dict objects with "@id" keys, return one
 def byId(they, x):
     for y in they:
@@ -1285,6 +1840,8 @@ def main():
     ap.add_argument('--outdir', default=None)
     ap.add_argument('--prefix', default='')
     ap.add_argument('--mark', help='bubbles to mark, json from scan.go or randvote.py')
+    ap.add_argument('--bubbles-only', default=False, action='store_true', help='only lay out ballots and write --bubbles json, no pdf')
+    ap.add_argument('--jobs', '-j', type=int, default=1, help='number of processes drawing ballot styles in parallel')
     args = ap.parse_args()
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -1300,11 +1857,14 @@ def main():
         marks = json.load(fin)
         fin.close()
 
+    # one id index for the whole report, shared by each Election
+    index = ObjectIndex(er)
     for el in er.get('Election', []):
-        ep = ElectionPrinter(er, el)
+        ep = ElectionPrinter(er, el, index)
         ep.setMarks(marks)
-        fnames_written = ep.drawToDir(args.outdir, args.prefix)
-        sys.stdout.write(', '.join(fnames_written) + '\n')
+        if not args.bubbles_only:
+            fnames_written = ep.drawToDir(args.outdir, args.prefix, workers=args.jobs)
+            sys.stdout.write(', '.join(fnames_written) + '\n')
         if args.bubbles:
             if args.bubbles == '-':
                 bout = sys.stdout
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#
+# Time ElectionPrinter setup, layout and drawing on big random elections.
+# e.g. heavily rotated candidate order across many precinct ballot styles:
+#   python3 -m ballotstudio.drawbench --towns 1000 --cand-max 40 --rotate
+
+import io
+import logging
+import random
+import time
+
+from . import draw
+from . import randrace
+
+logger = logging.getLogger(__name__)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+def bench(er, rounds=3, pdf=False):
+    "return {phase name: [seconds, ...], ...}"
+    draw._ensure_fonts()
+    out = {'init': [], 'layout': []}
+    if pdf:
+        out['pdf'] = []
+    for _ in range(rounds):
+        for el in er.get('Election', []):
+            # OrderedContestSelectionIds are resolved in ElectionPrinter()
+            ep, dt = timed(draw.ElectionPrinter, er, el)
+            out['init'].append(dt)
+            _, dt = timed(ep.layoutPlan)
+            out['layout'].append(dt)
+            if pdf:
+                _, dt = timed(ep.drawToFile, io.BytesIO())
+                out['pdf'].append(dt)
+    return out
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--counties', type=int, default=10)
+    ap.add_argument('--county-contests', type=int, default=3)
+    ap.add_argument('--towns', type=int, default=500)
+    ap.add_argument('--town-contests', type=int, default=3)
+    ap.add_argument('--top-contests', type=int, default=5)
+    ap.add_argument('--cand-min', type=int, default=5)
+    ap.add_argument('--cand-max', type=int, default=30)
+    ap.add_argument('--rotate', default=False, action='store_true', help='rotate candidate order on each ballot style')
+    ap.add_argument('--rounds', type=int, default=3)
+    ap.add_argument('--pdf', default=False, action='store_true', help='also time drawing the pdf')
+    ap.add_argument('--seed', type=int, default=None)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.seed is not None:
+        random.seed(args.seed)
+    rer = randrace.RandElection()
+    rer.numL2GpUnits = args.counties
+    rer.numLeafGpUnits = args.towns
+    rer.leafContests = args.town_contests
+    rer.l2Contests = args.county_contests
+    rer.topContests = args.top_contests
+    rer.candidatesPerContestMin = args.cand_min
+    rer.candidatesPerContestMax = args.cand_max
+    rer.rotateCandidates = args.rotate
+    er = rer.buildElectionReport()
+    nstyles = sum([len(el.get('BallotStyle', [])) for el in er.get('Election', [])])
+    ncsels = sum([len(co.get('ContestSelection', [])) for el in er.get('Election', []) for co in el.get('Contest', [])])
+    print('{} ballot styles, {} contest selections, rotate={}'.format(nstyles, ncsels, args.rotate))
+    for phase, times in bench(er, args.rounds, args.pdf).items():
+        print('{:8s} min {:.4f}s  median {:.4f}s'.format(phase, min(times), sorted(times)[len(times)//2]))
+    print('measureCache {!r}'.format(draw.measureCache.stats()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Minimal in-process counters and histograms in Prometheus text exposition format.
+# No client library needed, app.py serves exposition() at /metrics
+
+import contextlib
+import threading
+import time
+
+_registry = []
+_collectors = []
+_lock = threading.Lock()
+
+def _labelstr(labels):
+    if not labels:
+        return ''
+    parts = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append('{}="{}"'.format(k, v))
+    return '{' + ','.join(parts) + '}'
+
+def _num(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        # {((label, value), ...): count}
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} counter'.format(self.name)
+        for key, v in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, _labelstr(key), _num(v))
+
+# seconds, from a small ballot style to a few hundred pages
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # {((label, value), ...): [[count per bucket], sum, count]}
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            hv = self.values.get(key)
+            if hv is None:
+                hv = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    hv[0][i] += 1
+            hv[1] += value
+            hv[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def lines(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} histogram'.format(self.name)
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for le, n in zip(self.buckets, counts):
+                yield '{}_bucket{} {}'.format(self.name, _labelstr(key + (('le', _num(le)),)), n)
+            yield '{}_sum{} {}'.format(self.name, _labelstr(key), _num(total))
+            yield '{}_count{} {}'.format(self.name, _labelstr(key), count)
+
+def collector(fn):
+    """register fn() returning [(name, type, help, [({label: value}, number), ...]), ...]
+    for values that live elsewhere, read at scrape time"""
+    _collectors.append(fn)
+    return fn
+
+def exposition():
+    "all metrics as Prometheus text format"
+    with _lock:
+        out = []
+        for m in _registry:
+            out.extend(m.lines())
+    for fn in _collectors:
+        for name, mtype, help, samples in fn():
+            out.append('# HELP {} {}'.format(name, help))
+            out.append('# TYPE {} {}'.format(name, mtype))
+            for labels, v in samples:
+                out.append('{}{} {}'.format(name, _labelstr(sorted(labels.items())), _num(v)))
+    return '\n'.join(out) + '\n'
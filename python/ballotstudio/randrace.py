@@ -193,6 +193,8 @@ class RandElection:
         self.topContests = 2
         self.candidatesPerContestMin = 3
         self.candidatesPerContestMax = 13
+        # rotate candidate order per ballot style with OrderedContestSelectionIds
+        self.rotateCandidates = False
 
         typeSequences = Sequences()
         self.typeSequences = typeSequences
@@ -356,6 +358,18 @@ class RandElection:
         self.headers.append(header)
         return header
 
+    def orderedContest(self, contest, rotation=0):
+        oc = {
+            "@type": "ElectionResults.OrderedContest",
+            "ContestId": contest["@id"],
+        }
+        if self.rotateCandidates and (contest["@type"] == "ElectionResults.CandidateContest"):
+            contest["HasRotation"] = True
+            cselIds = [x["@id"] for x in contest["ContestSelection"]]
+            rotation = rotation % len(cselIds)
+            oc["OrderedContestSelectionIds"] = cselIds[rotation:] + cselIds[:rotation]
+        return oc
+
     def buildElectionReport(self):
         for _ in range(self.numParties):
             self.makeParty()
@@ -415,21 +429,8 @@ class RandElection:
                     "HeaderId": columnBreak["@id"],
                 },
             ]
-            for tcont in topContests:
-                oc.append({
-                    "@type": "ElectionResults.OrderedContest",
-                    "ContestId": tcont["@id"],
-                })
-            for tcont in l2cont:
-                oc.append({
-                    "@type": "ElectionResults.OrderedContest",
-                    "ContestId": tcont["@id"],
-                })
-            for tcont in lcont:
-                oc.append({
-                    "@type": "ElectionResults.OrderedContest",
-                    "ContestId": tcont["@id"],
-                })
+            for tcont in topContests + l2cont + lcont:
+                oc.append(self.orderedContest(tcont, len(bstyles)))
             bstyles.append({
                 "@type": "ElectionResults.BallotStyle",
                 "GpUnitIds": [lgpu["@id"]],
@@ -466,6 +467,7 @@ def main():
     ap.add_argument('--top-contests', type=int, default=2, help='number of contests to run at the top level (state)')
     ap.add_argument('--cand-min', type=int, default=3, help='minimum number of candidates in a contest')
     ap.add_argument('--cand-max', type=int, default=9, help='maximum number of candidates in a contest')
+    ap.add_argument('--rotate', default=False, action='store_true', help='rotate candidate order on each ballot style')
     args = ap.parse_args()
     logging.basicConfig(level=logging.DEBUG)
     rer = RandElection()
@@ -477,6 +479,7 @@ def main():
     rer.topContests = args.top_contests
     rer.candidatesPerContestMin = args.cand_min
     rer.candidatesPerContestMax = args.cand_max
+    rer.rotateCandidates = args.rotate
     print(json.dumps(rer.buildElectionReport(), indent=2))
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+#
+# pdf pages to png, one `pdftoppm -png` process per page (poppler-utils)
+# concurrent rasterizations bounded by a semaphore
+
+import io
+import os
+import re
+import subprocess
+import threading
+
+from PIL import Image
+
+DEFAULT_DPI = 150
+MIN_DPI = 36
+MAX_DPI = 600
+
+# at most this many pdftoppm processes at once, $BALLOTSTUDIO_RASTER_WORKERS default cpu count
+_slots = threading.BoundedSemaphore(int(os.getenv('BALLOTSTUDIO_RASTER_WORKERS') or os.cpu_count() or 2))
+
+# resolutions a page is offered at, so callers can't ask for hundreds of variants of one page
+DPI_TIERS = (72, 150, 300, 600)
+
+class PageRangeError(Exception):
+    pass
+
+def clampDpi(dpi):
+    if dpi is None:
+        return DEFAULT_DPI
+    return max(MIN_DPI, min(MAX_DPI, int(dpi)))
+
+def dpiTier(dpi):
+    "smallest tier at least dpi, else the largest. None is DEFAULT_DPI"
+    if dpi is None:
+        return DEFAULT_DPI
+    for tier in DPI_TIERS:
+        if tier >= dpi:
+            return tier
+    return DPI_TIERS[-1]
+
+_pageRe = re.compile(rb'/Type\s*/Page\b')
+
+def pageCount(pdfbytes):
+    "number of pages, counted from page objects. reportlab doesn't put them in compressed object streams."
+    return len(_pageRe.findall(pdfbytes))
+
+def pageToPng(pdfbytes, page=1, dpi=DEFAULT_DPI):
+    "png bytes of one page (1 based) at dpi"
+    if (page < 1) or (page > pageCount(pdfbytes)):
+        raise PageRangeError('no page {}'.format(page))
+    cmd = ['pdftoppm', '-png', '-r', str(clampDpi(dpi)), '-f', str(page), '-l', str(page), '-singlefile', '-']
+    with _slots:
+        result = subprocess.run(cmd, input=pdfbytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception('pdftoppm failed ({}): {}'.format(result.returncode, result.stderr.decode(errors='replace').strip()))
+    return result.stdout
+
+# thumbnail tiers, pixels wide
+THUMB_WIDTHS = (120, 240, 480)
+# source raster for thumbnails, wider than the largest tier for letter, A4 and legal pages
+THUMB_DPI = 96
+
+def thumbWidth(width):
+    "smallest tier at least width wide, else the largest"
+    if width is None:
+        return THUMB_WIDTHS[0]
+    for tw in THUMB_WIDTHS:
+        if tw >= width:
+            return tw
+    return THUMB_WIDTHS[-1]
+
+def thumbnails(pngbytes, widths=THUMB_WIDTHS):
+    "{width: png bytes} for every tier, all scaled down from one page raster"
+    im = Image.open(io.BytesIO(pngbytes))
+    im.load()
+    out = {}
+    for width in widths:
+        height = max(1, round(im.height * width / im.width))
+        thumb = im.resize((width, height), Image.LANCZOS)
+        buf = io.BytesIO()
+        thumb.save(buf, format='PNG', optimize=True)
+        out[width] = buf.getvalue()
+    return out